@@ -1,10 +1,80 @@
-from typing import Dict
+from typing import Dict, List
 import itertools
+import inspect
+import hashlib
+import json
+import os
+import math
+import concurrent.futures
+import numpy as np
+import corpus
+import layout
+import store
+import timing
 
 JSON = Dict[str, any]
 
+# bump when a change alters the metrics of already scored layouts
+VERSION = 3
 
-def get_table():
+FINGERS = ['LP', 'LR', 'LM', 'LI', 'LT', 'RT', 'RI', 'RM', 'RR', 'RP']
+
+# metrics and thumbs that trade places when a layout's hands are swapped
+MIRRORED = {**dict(zip(FINGERS, reversed(FINGERS))), 'LTotal': 'RTotal', 'RTotal': 'LTotal'}
+
+# raw sums are kept per thumb, the AVG mode averages LT and RT
+THUMBS = ['LT', 'RT', 'NONE']
+MODES = THUMBS + ['AVG']
+
+CLASSES = [
+    'roll-in',
+    'roll-out',
+    'alternate',
+    'redirect',
+    'oneh-in',
+    'oneh-out',
+    'sfb',
+    'dsfb-alt',
+    'dsfb-red',
+    'sfT',
+    'sfR',
+    'unknown',
+]
+
+# bigram classes, the skip-gram counterpart of a true sfb is an sfs
+PAIR_CLASSES = ['true-sfb', 'lsb', 'scissor']
+
+# runs of trigram classes that 4- and 5-grams are scored on
+CHAINS = {
+    'roll': ['roll-in', 'roll-out'],
+    'alternate': ['alternate'],
+    'redirect': ['redirect'],
+}
+
+TABLE_FILE = os.path.join('src', 'static', 'table.json')
+
+BATCH_SIZE = 128
+
+# edits that move more characters than this are scored from scratch
+MAX_CHANGED = 8
+
+# approximate scoring keeps the most frequent trigrams and samples the rest
+APPROX_TOP_K = 1000
+APPROX_SAMPLE = 4000
+APPROX_RATIO = 8
+BOOTSTRAPS = 100
+CONFIDENCE = 0.95
+
+tensor = None
+table = None
+version = None
+custom = []
+chain_tables = {}
+
+worker_data = None
+
+
+def classify(seq: tuple):
 
     fingers = {
         'LP': 4,
@@ -18,95 +88,197 @@ def get_table():
         'RR': 3,
         'RP': 4,
     }
-    sequences = [item for item in itertools.product(fingers.keys(), repeat=3)]
-    
-    table = {}
-    for seq in sequences:
-        
-        # trigrams
-        if (
-            seq[0][0] == seq[2][0] and
-            seq[0][0] != seq[1][0]
-        ):
-            trigram_type = 'alternate'
-
-        elif (
-            (
-                seq[0][0] != seq[2][0] and
-                seq[0][0] == seq[1][0] and
-                fingers[seq[0]] < fingers[seq[1]]
-            ) or
-            (
-                seq[0][0] != seq[2][0] and
-                seq[1][0] == seq[2][0] and
-                fingers[seq[1]] < fingers[seq[2]]
-            )
-        ):
-            trigram_type = 'roll-out'
-
-        elif (
-            (
-                seq[0][0] != seq[2][0] and
-                seq[0][0] == seq[1][0] and
-                fingers[seq[0]] > fingers[seq[1]]
-            ) or
-            (
-                seq[0][0] != seq[2][0] and
-                seq[1][0] == seq[2][0] and
-                fingers[seq[1]] > fingers[seq[2]]
-            )
-        ):
-            trigram_type = 'roll-in'
-
-        elif (
-            fingers[seq[0]] >
-            fingers[seq[1]] >
-            fingers[seq[2]]
-        ):
-            trigram_type = 'oneh-in'
-
-        elif (
-            
-            fingers[seq[0]] < 
-            fingers[seq[1]] <
-            fingers[seq[2]]
-        ):
-            trigram_type = 'oneh-out'
 
-        else:
-            trigram_type = 'redirect'
-
-        # sfs 
-        if (
-            seq[0] != seq[2] and
-            seq[1] in [seq[0], seq[2]]
-        ):
-            trigram_type = 'sfb'
-
-        elif (
-            seq[0] == seq[2] and
-            seq[0] != seq[1] and
-            seq[0][0] == seq[1][0]
-        ):
-            trigram_type = 'dsfb-red'
-
-        elif (
-            seq[0] == seq[2] and
-            seq[0] != seq[1] and
-            seq[0][0] != seq[1][0]
-        ):
-            trigram_type = 'dsfb-alt'
-        
-        elif (
-            seq[0] == seq[1] and
-            seq[1] == seq[2]
-        ):
-            trigram_type = 'sfT'
+    # trigrams
+    if (
+        seq[0][0] == seq[2][0] and
+        seq[0][0] != seq[1][0]
+    ):
+        trigram_type = 'alternate'
+
+    elif (
+        (
+            seq[0][0] != seq[2][0] and
+            seq[0][0] == seq[1][0] and
+            fingers[seq[0]] < fingers[seq[1]]
+        ) or
+        (
+            seq[0][0] != seq[2][0] and
+            seq[1][0] == seq[2][0] and
+            fingers[seq[1]] < fingers[seq[2]]
+        )
+    ):
+        trigram_type = 'roll-out'
+
+    elif (
+        (
+            seq[0][0] != seq[2][0] and
+            seq[0][0] == seq[1][0] and
+            fingers[seq[0]] > fingers[seq[1]]
+        ) or
+        (
+            seq[0][0] != seq[2][0] and
+            seq[1][0] == seq[2][0] and
+            fingers[seq[1]] > fingers[seq[2]]
+        )
+    ):
+        trigram_type = 'roll-in'
+
+    elif (
+        fingers[seq[0]] >
+        fingers[seq[1]] >
+        fingers[seq[2]]
+    ):
+        trigram_type = 'oneh-in'
+
+    elif (
         
-        table['-'.join(seq)] = trigram_type
-    
-    return dict(sorted(table.items(), key=lambda x:x[1], reverse=True))
+        fingers[seq[0]] < 
+        fingers[seq[1]] <
+        fingers[seq[2]]
+    ):
+        trigram_type = 'oneh-out'
+
+    else:
+        trigram_type = 'redirect'
+
+    # sfs 
+    if (
+        seq[0] != seq[2] and
+        seq[1] in [seq[0], seq[2]]
+    ):
+        trigram_type = 'sfb'
+
+    elif (
+        seq[0] == seq[2] and
+        seq[0] != seq[1] and
+        seq[0][0] == seq[1][0]
+    ):
+        trigram_type = 'dsfb-red'
+
+    elif (
+        seq[0] == seq[2] and
+        seq[0] != seq[1] and
+        seq[0][0] != seq[1][0]
+    ):
+        trigram_type = 'dsfb-alt'
     
+    elif (
+        seq[0] == seq[1] and
+        seq[1] == seq[2]
+    ):
+        trigram_type = 'sfT'
+
+    return trigram_type
+
+
+def get_version():
+
+    global version
+
+    # changes whenever the classification rules or finger order change
+    if version is None:
+        source = inspect.getsource(classify) + '-'.join(FINGERS)
+        version = hashlib.md5(source.encode()).hexdigest()
+
+    return version
+
+
+def get_results_version():
+
+    # cached results are only reused by an analyzer with the same rules
+    return '-'.join([get_version(), str(VERSION)] + custom)
+
+
+def build_tensor():
+
+    tensor = np.zeros((len(FINGERS),) * 3, dtype=np.int8)
+    for seq in itertools.product(range(len(FINGERS)), repeat=3):
+        tensor[seq] = CLASSES.index(classify(tuple(FINGERS[i] for i in seq)))
+
+    return tensor
+
+
+def load_tensor(filename: str):
+
+    try:
+        saved = json.load(open(filename, 'r'))
+    except (OSError, ValueError):
+        return None
+
+    if saved.get('version') != get_version():
+        return None
+
+    codes = [CLASSES.index(saved['classes'][code]) for code in saved['table']]
+    return np.array(codes, dtype=np.int8).reshape((len(FINGERS),) * 3)
+
+
+def save_tensor(filename: str, tensor: np.ndarray):
+
+    saved = {
+        'version': get_version(),
+        'classes': CLASSES,
+        'table': tensor.ravel().tolist(),
+    }
+
+    try:
+        store.write_file(filename, json.dumps(saved, separators=store.COMPACT))
+    except OSError:
+        pass
+
+
+def get_tensor():
+
+    global tensor
+
+    # finger triple -> class id, indexed by position in FINGERS
+    if tensor is None:
+        tensor = load_tensor(TABLE_FILE)
+        if tensor is None:
+            tensor = build_tensor()
+            save_tensor(TABLE_FILE, tensor)
+
+    return tensor
+
+
+def get_table():
+
+    global table
+
+    if table is None:
+        codes = get_tensor()
+        table = {}
+        for seq in itertools.product(range(len(FINGERS)), repeat=3):
+            table['-'.join(FINGERS[i] for i in seq)] = CLASSES[codes[seq]]
+        table = dict(sorted(table.items(), key=lambda x:x[1], reverse=True))
+
+    return table
+
+
+def register_class(name: str, parent: str, rule):
+
+    global table
+
+    # split the finger triples of an existing class without rebuilding the table
+    codes = get_tensor()
+    if not name in CLASSES:
+        CLASSES.append(name)
+        custom.append(name)
+
+    for seq in zip(*np.nonzero(codes == CLASSES.index(parent))):
+        if rule(tuple(FINGERS[i] for i in seq)):
+            codes[seq] = CLASSES.index(name)
+
+    table = None
+    chain_tables.clear()
+
+
+def is_bad_redirect(seq: tuple):
+
+    # redirects that don't use an index finger, e.g.
+    # register_class('bad-redirect', 'redirect', is_bad_redirect)
+    return not any(finger[1] in 'IT' for finger in seq)
+
 
 def count_finger_use(keys: JSON, data: JSON, thumb: str):
 
@@ -131,6 +303,11 @@ def count_finger_use(keys: JSON, data: JSON, thumb: str):
             else:
                 counts[keys['keys'][char]['finger']] += data['1-grams'][char]
 
+    return get_finger_ratios(counts, thumb)
+
+
+def get_finger_ratios(counts: JSON, thumb: str):
+
     if thumb == 'NONE':
         counts['TB'] = 0
 
@@ -153,9 +330,14 @@ def count_row_use(keys: JSON, data: JSON):
     }
 
     for char in data['1-grams']:
-        if char in keys['keys'] and 'row' in keys['keys'][char]:
+        if char in keys['keys'] and 'row' in keys['keys'][char] and keys['keys'][char]['row'] < len(counts):
             row = ['top', 'home', 'bottom'][keys['keys'][char]['row']]
             counts[row] += data['1-grams'][char]
+
+    return get_row_ratios(counts)
+
+
+def get_row_ratios(counts: JSON):
     
     total = sum(counts.values())
     for finger in counts:
@@ -168,20 +350,8 @@ def count_trigrams(keys: JSON, data: JSON, thumb: str):
 
     table = get_table()
 
-    trigram_data = {
-        'roll-in': 0,
-        'roll-out': 0,
-        'alternate': 0,
-        'redirect': 0,
-        'oneh-in': 0,
-        'oneh-out': 0,
-        'sfb': 0,
-        'dsfb-alt': 0,
-        'dsfb-red': 0,
-        'sfT': 0,
-        'sfR': 0,
-        'unknown': 0,
-    }
+    trigram_data = {stat: 0 for stat in CLASSES}
+    unknown = 0
 
     for trigram in data['3-grams']:
         
@@ -210,6 +380,428 @@ def count_trigrams(keys: JSON, data: JSON, thumb: str):
                     trigram_data[table[key]] += data['3-grams'][trigram]
             else:
                 trigram_data['unknown'] += data['3-grams'][trigram]
+                unknown += 1
+
+    if timing.enabled:
+        timing.count('trigrams classified', len(data['3-grams']))
+        timing.count('unknown char hits', unknown)
+
+    return get_ratios(trigram_data)
+
+
+def get_fingers(layouts: List[JSON], chars: list, thumb: str):
+
+    # layout x char id -> finger id, -1 for characters a layout doesn't have
+    fingers = get_key_table(layouts, chars, 'fingers')
+    if ' ' in chars:
+        fingers[:, chars.index(' ')] = FINGERS.index(thumb) if thumb != 'NONE' else -1
+
+    return fingers
+
+
+def get_key_table(layouts: List[layout.Layout], chars: list, field: str):
+
+    # layout x char id -> one of the layouts' key arrays, gathered through the shared char ids
+    ids = np.array([layout.char_ids.get(char, -1) for char in chars], dtype=np.int64)
+    table = np.full((len(layouts), len(layout.chars) + 1), -1, dtype=np.int8)
+    for j, keys in enumerate(layouts):
+        values = getattr(keys, field)
+        table[j, :len(values)] = np.frombuffer(values, dtype=np.int8)
+
+    # unknown chars land on the last column, which stays -1
+    return table[:, ids]
+
+
+def get_rows(layouts: List[JSON], chars: list):
+
+    return get_key_table(layouts, chars, 'rows')
+
+
+def get_cols(layouts: List[JSON], chars: list):
+
+    return get_key_table(layouts, chars, 'cols')
+
+
+def classify_pair(a: JSON, b: JSON, same_char: bool):
+
+    # a and b are key entries of a layout, or None for characters it doesn't have
+    if a is None or b is None:
+        return None
+
+    fingers = (FINGERS.index(a['finger']), FINGERS.index(b['finger']))
+    grid = 'row' in a and 'row' in b
+
+    # shifted characters share their key with the unshifted one
+    if same_char or (grid and (a['row'], a['col']) == (b['row'], b['col'])):
+        return None
+    if fingers[0] == fingers[1]:
+        return 'true-sfb'
+
+    # neighbouring fingers of one hand, thumbs don't stretch
+    if abs(fingers[0] - fingers[1]) != 1 or a['finger'][1] == 'T' or b['finger'][1] == 'T' or not grid:
+        return None
+    if abs(a['row'] - b['row']) >= 2:
+        return 'scissor'
+    if abs(a['col'] - b['col']) >= 2:
+        return 'lsb'
+
+    return None
+
+
+def get_pair_grams(data: JSON):
+
+    if '2-grams' in data and 'skip-grams' in data:
+        return data['2-grams'], data['skip-grams']
+
+    # summed from the trigrams like corpus.get_pairs does
+    bigrams = {}
+    skipgrams = {}
+    for trigram, count in data['3-grams'].items():
+        bigrams[trigram[:2]] = bigrams.get(trigram[:2], 0) + count
+        skipgrams[trigram[0] + trigram[2]] = skipgrams.get(trigram[0] + trigram[2], 0) + count
+
+    return data.get('2-grams', bigrams), data.get('skip-grams', skipgrams)
+
+
+def count_pairs(keys: JSON, data: JSON):
+
+    counts = {stat: 0 for stat in PAIR_CLASSES + ['bigrams', 'sfs', 'skipgrams']}
+    bigrams, skipgrams = get_pair_grams(data)
+
+    # space has no key of its own here, a thumb never shares a finger with another key
+    for grams, total, stats in [(bigrams, 'bigrams', PAIR_CLASSES), (skipgrams, 'skipgrams', ['sfs'])]:
+        for pair, count in grams.items():
+            counts[total] += count
+            stat = classify_pair(keys['keys'].get(pair[0]), keys['keys'].get(pair[1]), pair[0] == pair[1])
+            if stat == 'true-sfb' and total == 'skipgrams':
+                stat = 'sfs'
+            if stat in stats:
+                counts[stat] += count
+
+    return get_pair_ratios(counts)
+
+
+def get_pair_ratios(counts: JSON):
+
+    return {
+        'true-sfb': counts['true-sfb'] / counts['bigrams'],
+        'lsb': counts['lsb'] / counts['bigrams'],
+        'scissor': counts['scissor'] / counts['bigrams'],
+        'sfs': counts['sfs'] / counts['skipgrams'],
+    }
+
+
+def get_pair_masks(fingers: np.ndarray, rows: np.ndarray, cols: np.ndarray, pairs: np.ndarray):
+
+    # (L, M) masks of every pair class, same rules as classify_pair
+    a, b = fingers[:, pairs[:, 0]].astype(np.int16), fingers[:, pairs[:, 1]].astype(np.int16)
+    rows_a, rows_b = rows[:, pairs[:, 0]].astype(np.int16), rows[:, pairs[:, 1]].astype(np.int16)
+    cols_a, cols_b = cols[:, pairs[:, 0]].astype(np.int16), cols[:, pairs[:, 1]].astype(np.int16)
+
+    known = (a >= 0) & (b >= 0)
+    grid = (rows_a >= 0) & (rows_b >= 0)
+    same_key = (pairs[:, 0] == pairs[:, 1]) | (grid & (rows_a == rows_b) & (cols_a == cols_b))
+    left, right = FINGERS.index('LT'), FINGERS.index('RT')
+
+    sfb = known & ~same_key & (a == b)
+    # compared directly, np.isin costs more than the masks on the few pairs a swap touches
+    stretch = (
+        known & grid & ~same_key & (np.abs(a - b) == 1) &
+        (a != left) & (a != right) & (b != left) & (b != right)
+    )
+    scissor = stretch & (np.abs(rows_a - rows_b) >= 2)
+    lsb = stretch & ~scissor & (np.abs(cols_a - cols_b) >= 2)
+
+    return {
+        'true-sfb': sfb,
+        'lsb': lsb,
+        'scissor': scissor,
+    }
+
+
+def count_pairs_batch(fingers: np.ndarray, rows: np.ndarray, cols: np.ndarray, arrays: JSON):
+
+    # binary corpora store counts in narrow integer types, a matmul would sum in those and overflow
+    bigram_counts = arrays['bigram-counts'].astype(np.float64)
+    skipgram_counts = arrays['skipgram-counts'].astype(np.float64)
+
+    sums = {stat: np.zeros(len(fingers), dtype=np.float64) for stat in PAIR_CLASSES + ['sfs']}
+    for start in range(0, len(fingers), BATCH_SIZE):
+        batch = slice(start, start + BATCH_SIZE)
+        masks = get_pair_masks(fingers[batch], rows[batch], cols[batch], arrays['bigrams'])
+        for stat in PAIR_CLASSES:
+            sums[stat][batch] = masks[stat] @ bigram_counts
+        masks = get_pair_masks(fingers[batch], rows[batch], cols[batch], arrays['skipgrams'])
+        sums['sfs'][batch] = masks['true-sfb'] @ skipgram_counts
+
+    sums = {stat: values.tolist() for stat, values in sums.items()}
+    totals = {'bigrams': float(bigram_counts.sum()), 'skipgrams': float(skipgram_counts.sum())}
+
+    return [
+        {**{stat: values[i] for stat, values in sums.items()}, **totals}
+        for i in range(len(fingers))
+    ]
+
+
+def count_pairs_np(keys: JSON, data: JSON):
+
+    arrays = corpus.encode(data)
+    chars = arrays['chars']
+    pairs = count_pairs_batch(
+        get_fingers([keys], chars, 'NONE'),
+        get_rows([keys], chars),
+        get_cols([keys], chars),
+        arrays
+    )[0]
+
+    return get_pair_ratios(pairs)
+
+
+def get_chain_stats():
+
+    # every chain metric followed by the n-gram totals they are divided by
+    stats = [chain + '-chain-' + str(n) for n in corpus.LONG for chain in CHAINS]
+    return stats + [str(n) + '-grams' for n in corpus.LONG]
+
+
+def get_chain(classes: List[str]):
+
+    for chain, members in CHAINS.items():
+        if all(stat in members for stat in classes):
+            return chain
+
+    return None
+
+
+def count_chains(keys: JSON, data: JSON, thumb: str):
+
+    table = get_table()
+
+    chain_data = {stat: 0 for stat in get_chain_stats()}
+
+    for n in corpus.LONG:
+        for seq, count in data.get(str(n) + '-grams', {}).items():
+
+            fingers = []
+            for char in seq:
+                if char == ' ':
+                    if thumb == 'NONE':
+                        break
+                    else:
+                        fingers.append(thumb)
+                elif char in keys['keys']:
+                    fingers.append(keys['keys'][char]['finger'])
+            else:
+                chain_data[str(n) + '-grams'] += count
+                if len(fingers) == n:
+                    chain = get_chain([table['-'.join(fingers[i:i+3])] for i in range(n - 2)])
+                    if chain:
+                        chain_data[chain + '-chain-' + str(n)] += count
+
+    return get_chain_ratios(chain_data)
+
+
+def get_chain_ratios(chain_data: JSON):
+
+    ratios = {}
+    for n in corpus.LONG:
+        total = chain_data[str(n) + '-grams']
+        for chain in CHAINS:
+            stat = chain + '-chain-' + str(n)
+            ratios[stat] = chain_data[stat] / total if total else 0
+
+    return ratios
+
+
+def get_chain_table(n: int):
+
+    # chain of every finger n-tuple, memoized since there are only 10^n of them
+    if not n in chain_tables:
+        codes = get_tensor()
+        seqs = np.indices((len(FINGERS),) * n).reshape(n, -1).T
+        windows = codes[seqs[:, :-2], seqs[:, 1:-1], seqs[:, 2:]]
+
+        # the extra last entry is for n-grams with a key the layout lacks
+        chains = np.full(len(seqs) + 1, len(CHAINS), dtype=np.int8)
+        for i, members in enumerate(CHAINS.values()):
+            chains[:-1][np.isin(windows, [CLASSES.index(stat) for stat in members]).all(axis=1)] = i
+
+        chain_tables[n] = chains
+
+    return chain_tables[n]
+
+
+def get_long_grams(arrays: JSON, thumb: str):
+
+    # (n, char ids, counts) of every longer n-gram set the corpus has
+    grams = []
+    for n, name in corpus.LONG.items():
+        if not name in arrays:
+            continue
+
+        ids = corpus.unpack(arrays[name], n, len(arrays['chars']))
+        counts = arrays[name[:-1] + '-counts']
+        if thumb == 'NONE' and ' ' in arrays['chars']:
+            counts = np.where((ids == arrays['chars'].index(' ')).any(axis=1), 0, counts)
+
+        grams.append((n, ids, counts))
+
+    return grams
+
+
+def get_sequences(fingers: np.ndarray, ids: np.ndarray):
+
+    # finger n-tuple index of every n-gram, or the unknown entry past the last one
+    n = ids.shape[1]
+    seqs = fingers[ids].astype(np.int64)
+
+    return np.where((seqs < 0).any(axis=1), len(FINGERS) ** n, seqs @ (len(FINGERS) ** np.arange(n - 1, -1, -1)))
+
+
+def count_chains_np(keys: JSON, data: JSON, thumb: str):
+
+    arrays = corpus.encode(data)
+    fingers = get_fingers([keys], arrays['chars'], 'NONE')
+
+    return get_chain_ratios(count_chains_thumbs(fingers, arrays, [thumb])[thumb][0])
+
+
+def get_classes(fingers: np.ndarray, trigrams: np.ndarray, repeats: np.ndarray):
+
+    # works on a single (V,) finger map or a stack of (L, V) maps
+    codes = get_tensor().ravel()
+    seqs = fingers[..., trigrams].astype(np.int16)
+
+    classes = codes[(seqs[..., 0] * len(FINGERS) + seqs[..., 1]) * len(FINGERS) + seqs[..., 2]]
+    classes[..., repeats] = CLASSES.index('sfR')
+    # columns or'd one by one, a reduce over the short last axis is much slower
+    unknown = (seqs[..., 0] < 0) | (seqs[..., 1] < 0) | (seqs[..., 2] < 0)
+    classes[unknown] = CLASSES.index('unknown')
+
+    if timing.enabled:
+        timing.count('trigrams classified', classes.size)
+        timing.count('unknown char hits', np.count_nonzero(unknown))
+
+    return classes
+
+
+def count_batch(lookup: np.ndarray, weights: np.ndarray, size: int):
+
+    # weighted bincount of every row of an (L, V) lookup, ignoring -1 entries
+    # and ids past the last bin, which would land in the next layout's bins
+    found = (lookup >= 0) & (lookup < size)
+    offsets = np.arange(len(lookup))[:, None] * size
+
+    return np.bincount(
+        (lookup + offsets)[found],
+        weights=np.broadcast_to(weights, lookup.shape)[found],
+        minlength=len(lookup) * size
+    ).reshape(len(lookup), size)
+
+
+def count_trigrams_batch(fingers: np.ndarray, arrays: JSON, thumb: str):
+
+    trigrams = arrays['trigrams']
+
+    # trigrams with space are thrown away entirely
+    counts = arrays['counts']
+    if thumb == 'NONE':
+        counts = np.where(arrays['spaces'], 0, counts)
+
+    sums = np.zeros((len(fingers), len(CLASSES)), dtype=np.float64)
+    for start in range(0, len(fingers), BATCH_SIZE):
+        classes = get_classes(fingers[start:start + BATCH_SIZE], trigrams, arrays['repeats'])
+
+        # one bincount over every layout in the chunk, offset by layout
+        offsets = np.arange(len(classes))[:, None] * len(CLASSES)
+        sums[start:start + len(classes)] = np.bincount(
+            (classes + offsets).ravel(),
+            weights=np.broadcast_to(counts, classes.shape).ravel(),
+            minlength=len(classes) * len(CLASSES)
+        ).reshape(len(classes), len(CLASSES))
+
+    return sums
+
+
+def get_thumb_fingers(fingers: np.ndarray, chars: list, thumb: str):
+
+    # a NONE finger map with space put on `thumb`
+    if thumb == 'NONE' or not ' ' in chars:
+        return fingers
+
+    fingers = fingers.copy()
+    fingers[:, chars.index(' ')] = FINGERS.index(thumb)
+
+    return fingers
+
+
+def split_spaces(arrays: JSON):
+
+    # trigrams without and with a space
+    return [
+        {name: arrays[name][mask] for name in ['trigrams', 'counts', 'spaces', 'repeats']}
+        for mask in [~arrays['spaces'], arrays['spaces']]
+    ]
+
+
+def count_trigrams_thumbs(fingers: np.ndarray, arrays: JSON, thumbs: List[str]=THUMBS):
+
+    # trigrams without a space classify the same under every thumb, so only the ones with one are scored per thumb
+    free, spaced = split_spaces(arrays)
+    sums = count_trigrams_batch(fingers, free, 'NONE')
+
+    return {
+        thumb: sums if thumb == 'NONE' else sums + count_trigrams_batch(get_thumb_fingers(fingers, arrays['chars'], thumb), spaced, thumb)
+        for thumb in thumbs
+    }
+
+
+def get_chain_sums(fingers: np.ndarray, ids: np.ndarray, counts: np.ndarray, chains: np.ndarray):
+
+    # n-grams are summed per finger sequence, only those get classified
+    by_seq = np.bincount(get_sequences(fingers, ids), weights=counts, minlength=len(chains))
+    return np.bincount(chains, weights=by_seq, minlength=len(CHAINS) + 1)
+
+
+def count_chains_thumbs(fingers: np.ndarray, arrays: JSON, thumbs: List[str]=THUMBS):
+
+    chars = arrays['chars']
+    thumb_fingers = {thumb: get_thumb_fingers(fingers, chars, thumb) for thumb in thumbs}
+    sums = {thumb: [{stat: 0.0 for stat in get_chain_stats()} for i in range(len(fingers))] for thumb in thumbs}
+
+    for n, ids, counts in get_long_grams(arrays, 'LT'):
+        chains = get_chain_table(n)
+        if ' ' in chars:
+            spaced = (ids == chars.index(' ')).any(axis=1)
+        else:
+            spaced = np.zeros(len(ids), dtype=bool)
+
+        # like trigrams, n-grams with a space are the only ones scored per thumb
+        totals = {thumb: float(counts.sum()) if thumb != 'NONE' else float(counts[~spaced].sum()) for thumb in thumbs}
+        for i in range(len(fingers)):
+            free = get_chain_sums(fingers[i], ids[~spaced], counts[~spaced], chains)
+            for thumb in thumbs:
+                by_chain = free
+                if thumb != 'NONE':
+                    by_chain = free + get_chain_sums(thumb_fingers[thumb][i], ids[spaced], counts[spaced], chains)
+
+                sums[thumb][i][str(n) + '-grams'] = totals[thumb]
+                for j, chain in enumerate(CHAINS):
+                    sums[thumb][i][chain + '-chain-' + str(n)] = float(by_chain[j])
+
+    return sums
+
+
+def count_trigrams_np(keys: JSON, data: JSON, thumb: str):
+
+    arrays = corpus.encode(data)
+    fingers = get_fingers([keys], arrays['chars'], thumb)
+    sums = count_trigrams_batch(fingers, arrays, thumb)[0]
+
+    return get_ratios(dict(zip(CLASSES, sums.tolist())))
+
+
+def get_ratios(trigram_data: JSON):
 
     total = sum(trigram_data.values())
     for stat in trigram_data:
@@ -219,43 +811,405 @@ def count_trigrams(keys: JSON, data: JSON, thumb: str):
     trigram_data['onehand'] = trigram_data['oneh-in'] + trigram_data['oneh-out']
     trigram_data['dsfb'] = trigram_data['dsfb-alt'] + trigram_data['dsfb-red']
 
-    if trigram_data['roll-out']:
-        trigram_data['roll-rt'] = trigram_data['roll-in'] / trigram_data['roll-out']
-    else:
-        trigram_data['roll-rt'] = float('inf')
+    trigram_data['roll-rt'] = get_rt(trigram_data['roll-in'], trigram_data['roll-out'])
+    trigram_data['oneh-rt'] = get_rt(trigram_data['oneh-in'], trigram_data['oneh-out'])
 
-    if trigram_data['oneh-out']:
-        trigram_data['oneh-rt'] = trigram_data['oneh-in'] / trigram_data['oneh-out']
+    return trigram_data
+
+
+def get_rt(inward, outward):
+
+    # inf without any outward trigrams, elementwise for arrays of sums
+    if isinstance(outward, np.ndarray):
+        return np.divide(inward, outward, out=np.full(outward.shape, float('inf')), where=outward != 0)
+
+    if outward:
+        return inward / outward
     else:
-        trigram_data['oneh-rt'] = float('inf')
+        return float('inf')
 
-    return trigram_data
 
+def get_results(keys: JSON, data: JSON, config: JSON, vectorized: bool=True):
 
-def get_results(keys: JSON, data: JSON, config: JSON):
+    if vectorized:
+        count_trigrams_fn = count_trigrams_np
+        count_pairs_fn = count_pairs_np
+        count_chains_fn = count_chains_np
+    else:
+        count_trigrams_fn = count_trigrams
+        count_pairs_fn = count_pairs
+        count_chains_fn = count_chains
+
+        # binary corpora only hold arrays, the reference counters read n-gram dicts
+        if not '3-grams' in data:
+            data = dict(data, **corpus.decode(data['arrays']))
     
     results = {
         'trigrams': {},
+        'bigrams': count_pairs_fn(keys, data),
+        'chains': {},
         'finger-use': count_finger_use(keys, data, config['thumb-space']),
         'row-use': count_row_use(keys, data),
     }
 
     if config['thumb-space'] == 'LT':
-        results['trigrams'] = count_trigrams(keys, data, 'LT')
+        results['trigrams'] = count_trigrams_fn(keys, data, 'LT')
     elif config['thumb-space'] == 'RT':
-        results['trigrams'] = count_trigrams(keys, data, 'RT')
+        results['trigrams'] = count_trigrams_fn(keys, data, 'RT')
     elif config['thumb-space'] == 'NONE':
-        results['trigrams'] = count_trigrams(keys, data, 'NONE')
+        results['trigrams'] = count_trigrams_fn(keys, data, 'NONE')
     elif config['thumb-space'] == 'AVG':
-        left_trigrams = count_trigrams(keys, data, 'LT')
-        right_trigrams = count_trigrams(keys, data, 'RT')
+        left_trigrams = count_trigrams_fn(keys, data, 'LT')
+        right_trigrams = count_trigrams_fn(keys, data, 'RT')
         for stat in left_trigrams:
             results['trigrams'][stat] = (left_trigrams[stat] + right_trigrams[stat]) / 2
 
+    if config['thumb-space'] == 'AVG':
+        left_chains = count_chains_fn(keys, data, 'LT')
+        right_chains = count_chains_fn(keys, data, 'RT')
+        results['chains'] = {stat: (left_chains[stat] + right_chains[stat]) / 2 for stat in left_chains}
+    else:
+        results['chains'] = count_chains_fn(keys, data, config['thumb-space'])
+
     return {k: v for d in results for k, v in results[d].items()}
 
-if __name__ == '__main__':
 
-    import json
-    with open('table.json', 'w') as f:
-        f.write(json.dumps(get_table(), indent=4))
\ No newline at end of file
+def get_thumbs(thumb: str):
+
+    # thumb modes whose trigram sums a thumb setting needs
+    if thumb == 'AVG':
+        return ['LT', 'RT']
+    else:
+        return [thumb]
+
+
+def get_metrics(raw: JSON, thumb: str):
+
+    if thumb == 'AVG':
+        left_trigrams = get_ratios(dict(raw['trigrams']['LT']))
+        right_trigrams = get_ratios(dict(raw['trigrams']['RT']))
+        trigrams = {stat: (left_trigrams[stat] + right_trigrams[stat]) / 2 for stat in left_trigrams}
+
+        left_chains = get_chain_ratios(raw['chains']['LT'])
+        right_chains = get_chain_ratios(raw['chains']['RT'])
+        chains = {stat: (left_chains[stat] + right_chains[stat]) / 2 for stat in left_chains}
+    else:
+        trigrams = get_ratios(dict(raw['trigrams'][thumb]))
+        chains = get_chain_ratios(raw['chains'][thumb])
+
+    return {
+        **trigrams,
+        **get_pair_ratios(raw['pairs']),
+        **chains,
+        **get_finger_ratios(dict(raw['finger-use']), thumb),
+        **get_row_ratios(dict(raw['row-use'])),
+    }
+
+
+def normalize_raw(raw: JSON, thumb: str):
+
+    # every group of sums scaled by the total its ratios divide by, so corpora of any size weigh the same
+    def scale(sums: JSON, stats: List[str], total: float):
+        return {stat: value / total if total and stat in stats else value for stat, value in sums.items()}
+
+    pairs = scale(raw['pairs'], PAIR_CLASSES + ['bigrams'], raw['pairs']['bigrams'])
+    pairs = scale(pairs, ['sfs', 'skipgrams'], raw['pairs']['skipgrams'])
+
+    chains = {}
+    for thumb_space, sums in raw['chains'].items():
+        for n in corpus.LONG:
+            sums = scale(sums, [chain + '-chain-' + str(n) for chain in CHAINS] + [str(n) + '-grams'], sums[str(n) + '-grams'])
+        chains[thumb_space] = sums
+
+    finger_use = raw['finger-use']
+    finger_total = sum(finger_use.values()) - (finger_use['TB'] if thumb == 'NONE' else 0)
+
+    return {
+        'trigrams': {
+            thumb_space: scale(sums, CLASSES, sum(sums.values()))
+            for thumb_space, sums in raw['trigrams'].items()
+        },
+        'chains': chains,
+        'pairs': pairs,
+        'finger-use': scale(finger_use, list(finger_use), finger_total),
+        'row-use': scale(raw['row-use'], list(raw['row-use']), sum(raw['row-use'].values())),
+    }
+
+
+def add_sums(total: JSON, sums: JSON, weight: float=1.0):
+
+    # nested sums of `sums` added into `total`
+    for stat, value in sums.items():
+        if type(value) == dict:
+            add_sums(total.setdefault(stat, {}), value, weight)
+        else:
+            total[stat] = total.get(stat, 0.0) + value * weight
+
+    return total
+
+
+def blend_raws(raws: List[JSON], weights: List[float], thumb: str):
+
+    # a weighted sum of normalized raws, get_metrics then gives the blended ratios
+    blended = {}
+    for raw, weight in zip(raws, weights):
+        add_sums(blended, normalize_raw(raw, thumb), weight)
+
+    return blended
+
+
+def is_symmetric():
+
+    # swapping hands reverses the finger order, so a symmetric table classifies a layout and its mirror alike
+    codes = get_tensor()
+    return bool((codes == codes[::-1, ::-1, ::-1]).all())
+
+
+def mirror_metrics(metrics: JSON):
+
+    # the metrics, or intervals, of the same layout with its hands swapped
+    return {MIRRORED.get(stat, stat): value for stat, value in metrics.items()}
+
+
+def mirror_raw(raw: JSON):
+
+    return {
+        'trigrams': mirror_metrics(raw['trigrams']),
+        'chains': mirror_metrics(raw['chains']),
+        'pairs': raw['pairs'],
+        'finger-use': mirror_metrics(raw['finger-use']),
+        'row-use': raw['row-use'],
+    }
+
+
+def get_use_weights(arrays: JSON):
+
+    # monograms with space left out, its count goes to TB on its own
+    chars = arrays['chars']
+    monograms = arrays['monograms']
+
+    if ' ' in chars:
+        return np.where(np.array(chars) == ' ', 0, monograms), float(monograms[chars.index(' ')])
+    else:
+        return monograms, 0
+
+
+def get_use(finger_sums: np.ndarray, row_sums: np.ndarray, space_count: float):
+
+    finger_use = []
+    for sums in finger_sums.tolist():
+        counts = {finger: sums[i] for i, finger in enumerate(FINGERS) if finger[1] != 'T'}
+        counts['TB'] = space_count
+        finger_use.append(counts)
+
+    row_use = [dict(zip(['top', 'home', 'bottom'], sums)) for sums in row_sums.tolist()]
+
+    return finger_use, row_use
+
+
+def count_use_batch(fingers: np.ndarray, rows: np.ndarray, arrays: JSON):
+
+    monograms, space_count = get_use_weights(arrays)
+
+    # finger and row sums for every layout, the space count goes to TB
+    finger_sums = count_batch(fingers, monograms, len(FINGERS))
+    row_sums = count_batch(rows, monograms, 3)
+
+    return get_use(finger_sums, row_sums, space_count)
+
+
+def get_raw_batch(layouts: List[JSON], data: JSON, thumbs: List[str]=THUMBS):
+
+    arrays = corpus.encode(data)
+    chars = arrays['chars']
+
+    fingers = get_fingers(layouts, chars, 'NONE')
+    rows = get_rows(layouts, chars)
+
+    finger_use, row_use = count_use_batch(fingers, rows, arrays)
+    pairs = count_pairs_batch(fingers, rows, get_cols(layouts, chars), arrays)
+
+    raws = [
+        {'trigrams': {}, 'chains': {}, 'pairs': pairs[i], 'finger-use': finger_use[i], 'row-use': row_use[i]}
+        for i in range(len(layouts))
+    ]
+    # one pass over the corpus for every thumb
+    sums = count_trigrams_thumbs(fingers, arrays, thumbs)
+    chains = count_chains_thumbs(fingers, arrays, thumbs)
+    for thumb in thumbs:
+        for raw, row, chain_data in zip(raws, sums[thumb].tolist(), chains[thumb]):
+            raw['trigrams'][thumb] = dict(zip(CLASSES, row))
+            raw['chains'][thumb] = chain_data
+
+    return raws
+
+
+def rescore_raw(base: JSON, keys: JSON, raw: JSON, data: JSON, max_changed: int=MAX_CHANGED):
+
+    arrays = corpus.encode(data)
+    chars = arrays['chars']
+    layouts = [base, keys]
+
+    fingers = get_fingers(layouts, chars, 'NONE')
+    rows = get_rows(layouts, chars)
+    cols = get_cols(layouts, chars)
+
+    # characters whose key moved between the two layouts, None if there are too many
+    changed = np.flatnonzero((fingers[0] != fingers[1]) | (rows[0] != rows[1]) | (cols[0] != cols[1]))
+    if len(changed) > max_changed:
+        return None
+
+    # use and pair counts are cheap enough to redo
+    finger_use, row_use = count_use_batch(fingers[1:], rows[1:], arrays)
+    new_raw = {
+        'trigrams': {},
+        'chains': {},
+        'pairs': count_pairs_batch(fingers[1:], rows[1:], cols[1:], arrays)[0],
+        'finger-use': finger_use[0],
+        'row-use': row_use[0],
+    }
+
+    # only trigrams and n-grams with a moved character change class
+    moved = np.zeros(len(chars), dtype=bool)
+    moved[changed] = True
+    touched = moved[arrays['trigrams'][:, 0]] | moved[arrays['trigrams'][:, 1]] | moved[arrays['trigrams'][:, 2]]
+    free, spaced = split_spaces({name: arrays[name][touched] for name in ['trigrams', 'counts', 'spaces', 'repeats']})
+
+    space = chars.index(' ') if ' ' in chars else -1
+    grams = []
+    for n, ids, counts in get_long_grams(arrays, 'LT'):
+        hit = moved[ids].any(axis=1)
+        grams.append((n, ids[hit], counts[hit], (ids[hit] == space).any(axis=1)))
+
+    def get_delta(fingers: np.ndarray, trigrams: JSON):
+        classes = get_classes(fingers, trigrams['trigrams'], trigrams['repeats'])
+        return (
+            np.bincount(classes[1], weights=trigrams['counts'], minlength=len(CLASSES)) -
+            np.bincount(classes[0], weights=trigrams['counts'], minlength=len(CLASSES))
+        )
+
+    def get_chain_delta(fingers: np.ndarray, n: int, ids: np.ndarray, counts: np.ndarray):
+        chains = get_chain_table(n)
+        return get_chain_sums(fingers[1], ids, counts, chains) - get_chain_sums(fingers[0], ids, counts, chains)
+
+    # the space-free part of the delta is shared by every thumb
+    delta = get_delta(fingers, free)
+    chain_deltas = [get_chain_delta(fingers, n, ids[~spaces], counts[~spaces]) for n, ids, counts, spaces in grams]
+
+    for thumb in raw['trigrams']:
+        thumb_fingers = get_thumb_fingers(fingers, chars, thumb)
+
+        sums = delta if thumb == 'NONE' else delta + get_delta(thumb_fingers, spaced)
+        new_raw['trigrams'][thumb] = {stat: raw['trigrams'][thumb][stat] + value for stat, value in zip(CLASSES, sums.tolist())}
+
+        new_raw['chains'][thumb] = dict(raw['chains'][thumb])
+        for (n, ids, counts, spaces), chain_delta in zip(grams, chain_deltas):
+            if thumb != 'NONE':
+                chain_delta = chain_delta + get_chain_delta(thumb_fingers, n, ids[spaces], counts[spaces])
+            for i, chain in enumerate(CHAINS):
+                new_raw['chains'][thumb][chain + '-chain-' + str(n)] += chain_delta[i]
+
+    return new_raw
+
+
+def get_sample(arrays: JSON, top_k: int=APPROX_TOP_K, size: int=APPROX_SAMPLE, seed: int=0):
+
+    # the top_k trigrams by count are kept exactly, `size` draws weighted by count stand in for the rest
+    order = np.argsort(-arrays['counts'], kind='stable')
+    head, rest = order[:top_k], order[top_k:]
+
+    # sampling only pays off for tails much longer than the sample
+    if len(rest) <= size * APPROX_RATIO:
+        return order, np.zeros(0, dtype=order.dtype), 0.0
+
+    counts = arrays['counts'][rest]
+    draws = np.random.default_rng(seed).choice(len(rest), size, p=counts / counts.sum())
+
+    # every draw is worth an equal share of the tail total
+    return head, rest[draws], float(counts.sum()) / size
+
+
+def get_approx_batch(
+    layouts: List[JSON], data: JSON, thumb: str, top_k: int=APPROX_TOP_K, size: int=APPROX_SAMPLE,
+    bootstraps: int=BOOTSTRAPS, confidence: float=CONFIDENCE, seed: int=0
+):
+
+    arrays = corpus.encode(data)
+    head, tail, unit = get_sample(arrays, top_k, size, seed)
+
+    # intervals is None when the corpus is small enough to score exactly
+    if not len(tail):
+        return get_raw_batch(layouts, data), None
+
+    rows = np.concatenate([head, tail])
+
+    # pairs, chains and use stay exact, only the trigrams are sampled
+    sampled = dict(arrays)
+    sampled['trigrams'] = arrays['trigrams'][rows]
+    sampled['counts'] = np.concatenate([arrays['counts'][head], np.full(len(tail), unit)])
+    sampled['spaces'] = arrays['spaces'][rows]
+    sampled['repeats'] = arrays['repeats'][rows]
+
+    raws = get_raw_batch(layouts, {'arrays': sampled}, get_thumbs(thumb))
+    intervals = [{metric: [value, value] for metric, value in get_metrics(raw, thumb).items()} for raw in raws]
+
+    # trigram sums of every layout under resamples of the tail draws
+    resamples = np.random.default_rng(seed + 1).multinomial(len(tail), np.full(len(tail), 1 / len(tail)), bootstraps) * unit
+    exact = {name: sampled[name][:len(head)] for name in ['trigrams', 'counts', 'spaces', 'repeats']}
+
+    ratios = []
+    for thumb_space in get_thumbs(thumb):
+        fingers = get_fingers(layouts, arrays['chars'], thumb_space)
+        weights = resamples
+        if thumb_space == 'NONE':
+            weights = np.where(arrays['spaces'][tail], 0, resamples)
+
+        # (layouts, resamples, classes), with get_ratios working on whole arrays of sums
+        head_sums = count_trigrams_batch(fingers, exact, thumb_space)
+        classes = get_classes(fingers, arrays['trigrams'][tail], arrays['repeats'][tail])
+        sums = np.empty((len(layouts), bootstraps, len(CLASSES)))
+        for start in range(0, len(layouts), BATCH_SIZE):
+            chunk = classes[start:start + BATCH_SIZE]
+            onehot = (chunk.T[:, :, None] == np.arange(len(CLASSES))).reshape(len(tail), -1).astype(np.float64)
+            sums[start:start + len(chunk)] = (weights @ onehot).reshape(bootstraps, len(chunk), len(CLASSES)).transpose(1, 0, 2)
+        sums += head_sums[:, None, :]
+        ratios.append(get_ratios(dict(zip(CLASSES, np.moveaxis(sums, -1, 0)))))
+
+    bounds = [50 * (1 - confidence), 50 * (1 + confidence)]
+    for stat in ratios[0]:
+        values = sum(ratio[stat] for ratio in ratios) / len(ratios)
+        for item, (low, high) in zip(intervals, np.percentile(values, bounds, axis=1, method='nearest').T.tolist()):
+            item[stat] = [low, high]
+
+    return raws, intervals
+
+
+def score_batch(layouts: List[JSON], data: JSON, thumb: str):
+
+    raws = get_raw_batch(layouts, data, get_thumbs(thumb))
+    return [get_metrics(raw, thumb) for raw in raws]
+
+
+def init_worker(datapath: str):
+
+    global worker_data
+
+    # each worker loads and encodes the corpus once
+    worker_data = corpus.load(datapath)
+    corpus.encode(worker_data)
+
+
+def raw_worker(layouts: List[JSON], thumbs: List[str]):
+
+    return get_raw_batch(layouts, worker_data, thumbs)
+
+
+def get_raw_parallel(layouts: List[JSON], datapath: str, thumbs: List[str], jobs: int):
+
+    # one contiguous chunk per worker keeps the merge order deterministic
+    size = math.ceil(len(layouts) / jobs)
+    chunks = [layouts[i:i + size] for i in range(0, len(layouts), size)]
+
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(datapath,)) as pool:
+        results = pool.map(raw_worker, chunks, [thumbs] * len(chunks))
+        return [raw for chunk in results for raw in chunk]
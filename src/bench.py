@@ -0,0 +1,194 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import math
+import os
+import statistics
+import sys
+import time
+import gendata
+import analyzer, corpus, layout, main
+from typing import Dict, List
+
+JSON = Dict[str, any]
+
+WORKERS = [1, 2, 4, 8]
+
+# bundled corpora from smallest to largest
+CORPORA = ['monkeytype-200', 'monkeytype-1k', 'monkeytype-10k', 'monkeytype-450k', 'german']
+REPEAT = 7
+SORT = ['roll', '-sfb', '-dsfb']
+
+# a stage is a regression once its median is this much slower than the baseline's
+TOLERANCE = 0.25
+
+
+def bench_gendata(file: str, workers: List[int]=WORKERS):
+
+    results = []
+    for count in workers:
+        start = time.perf_counter()
+        if count > 1:
+            part = gendata.count_parallel(file, count)
+        else:
+            part = gendata.count_range(file, 0, None)
+        seconds = time.perf_counter() - start
+
+        results.append({
+            'workers': count,
+            'words': part['words'],
+            'seconds': seconds,
+            'words/sec': part['words'] / seconds,
+        })
+
+    return results
+
+
+def time_runs(fn, repeat: int, setup=None):
+
+    # seconds of every run, `setup` runs untimed before each one
+    runs = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+
+    return runs
+
+
+def get_stats(runs: List[float], scale: int=1):
+
+    # nearest-rank p95, `scale` turns batch timings into per-item ones
+    runs = sorted(run / scale for run in runs)
+
+    return {
+        'median': statistics.median(runs),
+        'p95': runs[math.ceil(0.95 * len(runs)) - 1],
+        'runs': len(runs),
+    }
+
+
+def bench_stages(config: JSON, names: List[str]=CORPORA, repeat: int=REPEAT):
+
+    stages = {}
+    layouts = layout.load_dir(config['layoutdir'])
+
+    # corpus independent stages
+    stages['parse'] = get_stats(time_runs(
+        lambda: layout.load_dir(config['layoutdir']), repeat, layout.parsed.clear
+    ))
+    stages['table'] = get_stats(time_runs(analyzer.build_tensor, repeat))
+
+    for name in names:
+        datapath = corpus.get_path(config['datadir'], name)
+        stages[name + '/load'] = get_stats(time_runs(lambda: corpus.encode(corpus.load(datapath)), repeat))
+
+        data = corpus.load(datapath)
+        corpus.encode(data)
+
+        # per layout, from one batch over every layout
+        stages[name + '/score'] = get_stats(time_runs(
+            lambda: analyzer.score_batch(layouts, data, config['thumb-space']), repeat
+        ), len(layouts))
+
+        scores = analyzer.score_batch(layouts, data, config['thumb-space'])
+        results = {
+            'file': data['file'],
+            'data': [
+                {'name': keys['name'], 'file': keys['file'], 'hash': keys['hash'], 'mirror': keys['mirror'], 'sort': 0, 'metrics': metrics}
+                for keys, metrics in zip(layouts, scores)
+            ],
+        }
+
+        # sorting adds to every item's sort key, so each run gets fresh items
+        fresh = {}
+        stages[name + '/sort'] = get_stats(time_runs(
+            lambda: main.sort_results(fresh['results'], config), repeat,
+            lambda: fresh.update(results=copy.deepcopy(results))
+        ))
+
+        main.sort_results(results, config)
+        with contextlib.redirect_stdout(io.StringIO()):
+            stages[name + '/render'] = get_stats(time_runs(lambda: main.show_results(results, config), repeat))
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'thumb': config['thumb-space'],
+        'layouts': len(layouts),
+        'repeat': repeat,
+        'stages': stages,
+    }
+
+
+def compare(bench: JSON, baseline: JSON, tolerance: float=TOLERANCE):
+
+    # median change of every stage both runs have, positive is slower
+    changes = {}
+    for stage, stats in bench['stages'].items():
+        if stage in baseline['stages'] and baseline['stages'][stage]['median'] > 0:
+            changes[stage] = stats['median'] / baseline['stages'][stage]['median'] - 1
+
+    regressions = [stage for stage, change in changes.items() if change > tolerance]
+
+    return changes, regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='benchmark the analyzer')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    counting = commands.add_parser('gendata', help='n-gram counting throughput per worker count')
+    counting.add_argument('input', help='plain text corpus')
+    counting.add_argument('--workers', type=int, nargs='+', default=WORKERS)
+
+    stages = commands.add_parser('stages', help='load, parse, table, score, sort and render timings per corpus')
+    stages.add_argument('--data', nargs='+', default=CORPORA, help='corpora in data/')
+    stages.add_argument('--repeat', type=int, default=REPEAT, help='timed runs per stage')
+    stages.add_argument('--thumb', default='AVG', choices=['LT', 'RT', 'NONE', 'AVG'])
+    stages.add_argument('-o', '--output', help='write the timings as json')
+    stages.add_argument('--baseline', help='json of an earlier run to check for regressions')
+    stages.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed median slowdown, 0.25 is 25%%')
+
+    args = parser.parse_args()
+
+    if args.command == 'gendata':
+        print('workers'.rjust(8), 'words'.rjust(12), 'seconds'.rjust(10), 'words/sec'.rjust(12))
+        for result in bench_gendata(args.input, args.workers):
+            print(
+                str(result['workers']).rjust(8),
+                str(result['words']).rjust(12),
+                "{:.2f}".format(result['seconds']).rjust(10),
+                "{:.0f}".format(result['words/sec']).rjust(12),
+            )
+
+    elif args.command == 'stages':
+        config = json.load(open(os.path.join('src', 'static', 'config-init.json'), 'r'))
+        config['thumb-space'] = args.thumb
+        config['sort'] = main.parse_metrics(SORT)
+
+        bench = bench_stages(config, args.data, args.repeat)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(json.dumps(bench, indent=4))
+
+        changes, regressions = {}, []
+        if args.baseline:
+            changes, regressions = compare(bench, json.load(open(args.baseline, 'r')), args.tolerance)
+
+        print('stage'.ljust(24), 'median ms'.rjust(10), 'p95 ms'.rjust(10), ('change' if args.baseline else '').rjust(8))
+        for stage, stats in bench['stages'].items():
+            print(
+                stage.ljust(24),
+                "{:.3f}".format(stats['median'] * 1000).rjust(10),
+                "{:.3f}".format(stats['p95'] * 1000).rjust(10),
+                ("{:+.0%}".format(changes[stage]) if stage in changes else '').rjust(8),
+                'slower' if stage in regressions else '',
+            )
+
+        if regressions:
+            sys.exit(str(len(regressions)) + ' stage(s) slower than the baseline')
@@ -0,0 +1,64 @@
+import sys
+import json
+import server
+import timing
+from typing import Dict, List
+
+JSON = Dict[str, any]
+
+
+def parse_flags(argv: List[str]):
+
+    args = []
+    flags = {}
+
+    argv = iter(argv)
+    for arg in argv:
+        if arg in ['--jobs', '-j']:
+            flags['jobs'] = int(next(argv))
+        elif arg == '--json':
+            flags['json'] = True
+        elif arg == '--approx':
+            flags['approx'] = True
+        elif arg == '--profile' or arg.startswith('--profile='):
+            flags['profile'] = arg.partition('=')[2] or True
+        else:
+            args.append(arg)
+
+    return args, flags
+
+
+def write_response(response: JSON, flags: JSON):
+
+    if 'error' in response:
+        sys.exit(response['error'])
+
+    if flags.get('json'):
+        print(json.dumps({'config': response['config'], 'results': response['results']}))
+    else:
+        sys.stdout.write(response['output'])
+
+
+def main(argv: List[str], run_local=None):
+
+    args, flags = parse_flags(argv)
+
+    # serving and profiled runs stay in this process, a running server answers the rest from its warm caches
+    response = None
+    if args[1:2] != ['serve'] and not timing.get_setting(flags.get('profile')):
+        response = server.forward(argv)
+
+    # numpy, the analyzer and the corpora are only imported when no server answered
+    if response is None:
+        if run_local is None:
+            import main as app
+            run_local = app.run_local
+        response = run_local(argv)
+
+    if response is not None:
+        write_response(response, flags)
+
+
+if __name__ == '__main__':
+
+    main(sys.argv)
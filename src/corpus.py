@@ -0,0 +1,289 @@
+import sys
+import os
+import json
+import struct
+import numpy as np
+from typing import Dict
+
+JSON = Dict[str, any]
+
+MAGIC = b'A200CRP1'
+
+# the masks and summed pairs are stored too, so loading does no work that grows with the corpus
+ARRAYS = [
+    'monograms', 'trigrams', 'counts', 'spaces', 'repeats',
+    'bigrams', 'bigram-counts', 'skipgrams', 'skipgram-counts',
+    'quadgrams', 'quadgram-counts', 'pentagrams', 'pentagram-counts',
+]
+INTEGERS = [np.int8, np.int16, np.int32, np.int64]
+
+# skip-grams are the outer characters of a trigram, "a_c" of "abc"
+PAIRS = {
+    'bigrams': ('2-grams', [0, 1]),
+    'skipgrams': ('skip-grams', [0, 2]),
+}
+
+# optional longer n-grams, kept sparse as one packed integer key per n-gram
+LONG = {
+    4: 'quadgrams',
+    5: 'pentagrams',
+}
+
+# how the counts were made, appending checks these
+META = ['kind', 'min-count']
+
+
+def encode(data: JSON):
+
+    # encode once per corpus, later calls reuse the arrays
+    if 'arrays' in data:
+        return data['arrays']
+
+    grams = [data['3-grams']] + [data[gram] for gram, columns in PAIRS.values() if gram in data]
+    grams += [data[str(n) + '-grams'] for n in LONG if str(n) + '-grams' in data]
+    chars = sorted(set(data['1-grams']) | {char for counts in grams for seq in counts for char in seq})
+    index = {char: i for i, char in enumerate(chars)}
+
+    monograms = np.zeros(len(chars), dtype=np.float64)
+    for char, count in data['1-grams'].items():
+        monograms[index[char]] = count
+
+    trigrams = np.array(
+        [[index[char] for char in trigram] for trigram in data['3-grams']],
+        dtype=np.int32
+    ).reshape(-1, 3)
+    counts = np.array(list(data['3-grams'].values()), dtype=np.float64)
+
+    data['arrays'] = {
+        'chars': chars,
+        'monograms': monograms,
+        'trigrams': trigrams,
+        'counts': counts,
+    }
+    data['arrays'].update(get_masks(data['arrays']))
+
+    for name, (gram, columns) in PAIRS.items():
+        if gram in data:
+            data['arrays'][name] = np.array(
+                [[index[char] for char in pair] for pair in data[gram]],
+                dtype=np.int32
+            ).reshape(-1, 2)
+            data['arrays'][name[:-1] + '-counts'] = np.array(list(data[gram].values()), dtype=np.float64)
+    data['arrays'].update(get_pairs(data['arrays']))
+
+    for n, name in LONG.items():
+        if str(n) + '-grams' in data:
+            ids = np.array(
+                [[index[char] for char in seq] for seq in data[str(n) + '-grams']],
+                dtype=np.int64
+            ).reshape(-1, n)
+            data['arrays'][name] = pack(ids, len(chars))
+            data['arrays'][name[:-1] + '-counts'] = np.array(list(data[str(n) + '-grams'].values()), dtype=np.float64)
+
+    return data['arrays']
+
+
+def pack(ids: np.ndarray, size: int):
+
+    # base-`size` digits of the char ids, first char most significant
+    if size ** ids.shape[1] >= 2 ** 63:
+        raise ValueError('alphabet of ' + str(size) + ' is too large to pack ' + str(ids.shape[1]) + '-grams')
+
+    keys = np.zeros(len(ids), dtype=np.int64)
+    for i in range(ids.shape[1]):
+        keys = keys * size + ids[:, i]
+
+    return keys
+
+
+def unpack(keys: np.ndarray, n: int, size: int):
+
+    ids = np.empty((len(keys), n), dtype=np.int32)
+    for i in reversed(range(n)):
+        keys, ids[:, i] = np.divmod(keys, size)
+
+    return ids
+
+
+def decode(arrays: JSON):
+
+    # the json form of encoded n-gram counts
+    chars = arrays['chars']
+
+    def join(ids: np.ndarray, counts: np.ndarray):
+        return {''.join(chars[i] for i in seq): count for seq, count in zip(ids.tolist(), counts.tolist())}
+
+    data = {
+        '1-grams': {char: count for char, count in zip(chars, arrays['monograms'].tolist()) if count},
+        '3-grams': join(arrays['trigrams'], arrays['counts']),
+    }
+
+    for name, (gram, columns) in PAIRS.items():
+        data[gram] = join(arrays[name], arrays[name[:-1] + '-counts'])
+
+    for n, name in LONG.items():
+        if name in arrays:
+            data[str(n) + '-grams'] = join(unpack(arrays[name], n, len(chars)), arrays[name[:-1] + '-counts'])
+
+    return data
+
+
+def get_masks(arrays: JSON):
+
+    trigrams = arrays['trigrams']
+
+    if ' ' in arrays['chars']:
+        spaces = (trigrams == arrays['chars'].index(' ')).any(axis=1)
+    else:
+        spaces = np.zeros(len(trigrams), dtype=bool)
+
+    # trigrams that repeat a character are counted as sfR
+    repeats = (
+        (trigrams[:, 0] == trigrams[:, 1]) |
+        (trigrams[:, 1] == trigrams[:, 2]) |
+        (trigrams[:, 0] == trigrams[:, 2])
+    )
+
+    return {
+        'spaces': spaces,
+        'repeats': repeats,
+    }
+
+
+def get_pairs(arrays: JSON):
+
+    # corpora without pair counts get them summed from their trigrams
+    pairs = {}
+    for name, (gram, columns) in PAIRS.items():
+        if name in arrays:
+            continue
+
+        size = len(arrays['chars'])
+        ids = arrays['trigrams'][:, columns[0]].astype(np.int64) * size + arrays['trigrams'][:, columns[1]]
+        ids, inverse = np.unique(ids, return_inverse=True)
+
+        pairs[name] = np.stack([ids // size, ids % size], axis=1).astype(np.int32).reshape(-1, 2)
+        pairs[name[:-1] + '-counts'] = np.bincount(inverse.ravel(), weights=arrays['counts'], minlength=len(ids))
+
+    return pairs
+
+
+def align(offset: int):
+
+    return -(-offset // 8) * 8
+
+
+def narrow(array: np.ndarray):
+
+    # the smallest signed integer type that holds every value, masks and counts that aren't whole stay as they are
+    if array.dtype.kind == 'b' or (array.dtype.kind == 'f' and not np.array_equal(array, np.round(array))):
+        return array
+
+    for dtype in INTEGERS:
+        info = np.iinfo(dtype)
+        if not array.size or (array.min() >= info.min and array.max() <= info.max):
+            return array.astype(dtype)
+
+    return array
+
+
+def save(filename: str, data: JSON):
+
+    arrays = encode(data)
+
+    header = {
+        'file': data['file'],
+        'chars': arrays['chars'],
+        'arrays': {},
+    }
+    header.update({name: data[name] for name in META if name in data})
+
+    offset = 0
+    blobs = []
+    for name in [name for name in ARRAYS if name in arrays]:
+        array = np.ascontiguousarray(narrow(arrays[name]))
+        header['arrays'][name] = {
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'offset': offset,
+        }
+        blob = array.tobytes()
+        blobs.append(blob + bytes(align(len(blob)) - len(blob)))
+        offset += align(len(blob))
+
+    head = json.dumps(header).encode()
+    start = len(MAGIC) + 4 + len(head)
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(head)))
+        f.write(head)
+        f.write(bytes(align(start) - start))
+        for blob in blobs:
+            f.write(blob)
+
+
+def load_binary(filename: str):
+
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(filename + ' is not a corpus file')
+        size = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(size))
+
+    # every array is a read-only view into the one mapping
+    start = align(len(MAGIC) + 4 + size)
+    buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+
+    arrays = {'chars': header['chars']}
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(info['dtype'])
+        offset = start + info['offset']
+        count = int(np.prod(info['shape']))
+        arrays[name] = buffer[offset:offset + count * dtype.itemsize].view(dtype).reshape(info['shape'])
+
+    # files written without the masks or pair counts
+    if not 'spaces' in arrays:
+        arrays.update(get_masks(arrays))
+    arrays.update(get_pairs(arrays))
+
+    monograms = arrays['monograms'].tolist()
+
+    return {
+        'file': header['file'],
+        **{name: header[name] for name in META if name in header},
+        '1-grams': {char: count for char, count in zip(arrays['chars'], monograms) if count},
+        'arrays': arrays,
+    }
+
+
+def get_path(datadir: str, name: str):
+
+    # a binary corpus is used unless the json next to it is newer
+    jsonpath = os.path.join(datadir, name + '.json')
+    binpath = os.path.join(datadir, name + '.bin')
+
+    if os.path.isfile(binpath) and (
+        not os.path.isfile(jsonpath) or
+        os.path.getmtime(binpath) >= os.path.getmtime(jsonpath)
+    ):
+        return binpath
+
+    return jsonpath
+
+
+def load(filename: str):
+
+    if filename.endswith('.bin'):
+        return load_binary(filename)
+    else:
+        return json.load(open(filename, 'r'))
+
+
+if __name__ == '__main__':
+
+    # convert data/*.json files to the binary format next to them
+    for filename in sys.argv[1:]:
+        outfile = os.path.splitext(filename)[0] + '.bin'
+        save(outfile, json.load(open(filename, 'r')))
+        print(filename, '->', outfile)
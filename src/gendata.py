@@ -1,5 +1,20 @@
 from typing import List
+from collections import Counter
+import argparse
+import concurrent.futures
+import heapq
+import itertools
 import json
+import os
+import analyzer, corpus, layout, store
+
+CHUNK_LINES = 100000
+MAX_KEYS = 2000000
+
+# longest n-grams counted and how rare 4- and 5-grams are pruned
+MAX_N = 3
+MIN_COUNT = 2
+
 
 def get_monograms(file: str):
 
@@ -57,18 +72,499 @@ def get_trigrams(file: str):
     return dict(sorted(trigrams.items(), key=lambda x: x[1], reverse=True))
 
 
-if __name__ == '__main__':
+def read_chunks(file: str, chunk_lines: int=CHUNK_LINES, start: int=0, end: int=None):
+
+    # words of every line joined by single spaces, one string per chunk
+    with open(file, 'rb') as f:
+        f.seek(start)
+        words = []
+        lines = 0
+        while end is None or f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            words += line.decode('utf-8', errors='replace').split()
+            lines += 1
+            if lines % chunk_lines == 0 and words:
+                yield ' '.join(words) + ' '
+                words = []
+        if words:
+            yield ' '.join(words) + ' '
+
+
+def count_text(text: str, start: int=0, max_n: int=MAX_N):
+
+    # n-grams that begin before `start` were counted with the previous chunk
+    grams = []
+    for n in range(1, 4):
+        offset = max(start - n + 1, 0)
+        grams.append(Counter(text[i:i+n] for i in range(offset, len(text) - n + 1)))
+
+    # then skip-grams, the outer characters of every trigram
+    offset = max(start - 2, 0)
+    grams.append(Counter(text[i] + text[i+2] for i in range(offset, len(text) - 2)))
+
+    # and the optional longer n-grams last
+    for n in range(4, max_n + 1):
+        offset = max(start - n + 1, 0)
+        grams.append(Counter(text[i:i+n] for i in range(offset, len(text) - n + 1)))
+
+    return grams
+
+
+def merge(totals: List[Counter], counts: List[Counter]):
+
+    for total, count in zip(totals, counts):
+        total.update(count)
+
+
+def spill(totals: List[Counter], spilldir: str, spills: List[List[str]]):
+
+    # every n-gram set becomes a run of [seq, count] lines sorted by seq, so runs merge without being loaded
+    runs = []
+    for i, total in enumerate(totals):
+        filename = os.path.join(spilldir, 'spill-' + str(len(spills)) + '-' + str(i) + '.jsonl')
+        with open(filename, 'w') as f:
+            for seq in sorted(total):
+                f.write(json.dumps([seq, total[seq]]) + '\n')
+        runs.append(filename)
+        total.clear()
+
+    spills.append(runs)
+
 
-    file = 'monkeytype-450k'
+def read_run(filename: str):
 
-    results = {
-        'file': 'wordlists/' + file + '.json',
-        '1-grams': {},
-        '3-grams': {},
+    with open(filename, 'r') as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+    os.remove(filename)
+
+
+def merge_runs(filenames: List[str]):
+
+    # one line of every run is held at a time, the counts of equal n-grams are summed
+    merged = heapq.merge(*[read_run(filename) for filename in filenames], key=lambda item: item[0])
+    for seq, items in itertools.groupby(merged, key=lambda item: item[0]):
+        yield seq, sum(count for _, count in items)
+
+
+def count_stream(file: str, chunk_lines: int=CHUNK_LINES, spilldir: str=None, max_keys: int=MAX_KEYS, max_n: int=MAX_N):
+
+    part = count_range(file, 0, None, chunk_lines, spilldir, max_keys, max_n)
+    if not part['spills']:
+        return [dict(total.most_common()) for total in part['grams']]
+
+    # spilled counts stream out of their runs as (seq, count) pairs in seq order
+    spill(part['grams'], spilldir, part['spills'])
+    return [merge_runs([runs[i] for runs in part['spills']]) for i in range(len(part['grams']))]
+
+
+def count_range(
+    file: str, start: int, end: int, chunk_lines: int=CHUNK_LINES,
+    spilldir: str=None, max_keys: int=MAX_KEYS, max_n: int=MAX_N
+):
+
+    totals = [Counter() for i in range(max(max_n, 3) + 1)]
+    spills = []
+    head = ''
+    words = 0
+
+    # the last n - 1 characters of a chunk start the n-grams of the next one
+    context = max(max_n, 3) - 1
+    tail = ''
+    for text in read_chunks(file, chunk_lines, start, end):
+        merge(totals, count_text(tail + text, len(tail), max_n))
+        head = head or text[:context]
+        tail = text[-context:]
+        words += text.count(' ')
+
+        if spilldir and sum(len(total) for total in totals) > max_keys:
+            spill(totals, spilldir, spills)
+
+    return {
+        'grams': totals,
+        'spills': spills,
+        'head': head,
+        'tail': tail,
+        'words': words,
     }
 
-    results['1-grams'] = get_monograms(results['file'])
-    results['3-grams'] = get_trigrams(results['file'])
 
-    with open(file + '.json', 'w') as f:
-        f.write(json.dumps(results, indent=4))
\ No newline at end of file
+def get_shards(file: str, shards: int):
+
+    # byte offsets of roughly equal shards, moved forward to line starts
+    size = os.path.getsize(file)
+    bounds = [0]
+    with open(file, 'rb') as f:
+        for i in range(1, shards):
+            f.seek(size * i // shards)
+            f.readline()
+            bounds.append(max(f.tell(), bounds[-1]))
+    bounds.append(size)
+
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def count_shard(file: str, start: int, end: int, chunk_lines: int, max_n: int):
+
+    return count_range(file, start, end, chunk_lines, max_n=max_n)
+
+
+def merge_parts(left: dict, right: dict):
+
+    if not left['tail']:
+        return right
+    if not right['head']:
+        return left
+
+    # n-grams that start in the left shard and end in the right one
+    text = left['tail'] + right['head']
+    boundary = [
+        Counter(text[i:i+n] for i in range(len(left['tail']) - n + 1, len(left['tail'])) if i + n <= len(text))
+        for n in range(1, 4)
+    ]
+    boundary.append(Counter(
+        text[i] + text[i+2] for i in range(len(left['tail']) - 2, len(left['tail'])) if i >= 0 and i + 3 <= len(text)
+    ))
+
+    # parts hold n-grams up to len(grams) - 1
+    boundary += [
+        Counter(text[i:i+n] for i in range(len(left['tail']) - n + 1, len(left['tail'])) if i >= 0 and i + n <= len(text))
+        for n in range(4, len(left['grams']))
+    ]
+
+    merge(left['grams'], right['grams'])
+    merge(left['grams'], boundary)
+
+    return {
+        'grams': left['grams'],
+        'head': left['head'],
+        'tail': right['tail'],
+        'words': left['words'] + right['words'],
+    }
+
+
+def reduce_parts(parts: List[dict], pool, merge_fn=merge_parts):
+
+    # merge neighbouring parts pairwise until one is left, keeping stream order
+    while len(parts) > 1:
+        merged = list(pool.map(merge_fn, parts[0:len(parts) - 1:2], parts[1::2]))
+        if len(parts) % 2:
+            merged.append(parts[-1])
+        parts = merged
+
+    return parts[0]
+
+
+def count_parallel(file: str, workers: int, chunk_lines: int=CHUNK_LINES, max_n: int=MAX_N):
+
+    shards = get_shards(file, workers)
+    if not shards:
+        return count_range(file, 0, None, chunk_lines, max_n=max_n)
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        parts = list(pool.map(
+            count_shard,
+            [file] * len(shards),
+            [start for start, end in shards],
+            [end for start, end in shards],
+            [chunk_lines] * len(shards),
+            [max_n] * len(shards)
+        ))
+        return reduce_parts(parts, pool)
+
+
+def prune(counts: dict, min_count: int):
+
+    # spilled (seq, count) pairs stay a stream
+    if not isinstance(counts, dict):
+        return ((seq, count) for seq, count in counts if count >= min_count)
+
+    return {seq: count for seq, count in counts.items() if count >= min_count}
+
+
+def get_pairs(trigrams: dict):
+
+    # 2-grams and skip-grams of a wordlist, summed from its weighted trigrams
+    bigrams = Counter()
+    skipgrams = Counter()
+    for seq, count in trigrams.items():
+        bigrams[seq[:2]] += count
+        skipgrams[seq[0] + seq[2]] += count
+
+    return dict(bigrams.most_common()), dict(skipgrams.most_common())
+
+
+def count_words(texts: List[str]):
+
+    counts = {
+        '1-grams': Counter({' ': 0}),
+        '3-grams': Counter(),
+        'start': Counter(),
+        'end': Counter(),
+    }
+
+    for word in texts:
+        counts['1-grams'].update(word)
+        counts['1-grams'][' '] += 1
+
+        padded_word = ' ' + word + ' '
+        counts['3-grams'].update(padded_word[i:i+3] for i in range(len(padded_word) - 2))
+
+        counts['start'][word[0]] += 1
+        counts['end'][word[-1]] += 1
+
+    return counts
+
+
+def merge_counts(left: dict, right: dict):
+
+    for item in left:
+        left[item].update(right[item])
+
+    return left
+
+
+def get_wordlist_parallel(file: str, workers: int):
+
+    texts = json.load(open(file, 'r'))['texts']
+
+    # contiguous shards, so merged counters keep first-occurrence order
+    size = -(-len(texts) // workers)
+    shards = [texts[i:i + size] for i in range(0, len(texts), size)]
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        counts = reduce_parts(list(pool.map(count_words, shards)), pool, merge_counts)
+
+    # same weighting as get_trigrams
+    word_count = len(texts)
+    trigrams = {seq: count * word_count for seq, count in counts['3-grams'].items()}
+    for start in counts['start']:
+        for end in counts['end']:
+            trigrams[end + ' ' + start] = counts['start'][start] * counts['end'][end]
+
+    return (
+        dict(sorted(counts['1-grams'].items(), key=lambda x: x[1], reverse=True)),
+        dict(sorted(trigrams.items(), key=lambda x: x[1], reverse=True)),
+    )
+
+
+def get_max_n(data: dict):
+
+    # an append counts every n-gram length the corpus already has
+    return max([3] + [n for n in range(4, 6) if str(n) + '-grams' in data])
+
+
+def merge_data(data: dict, grams: List[dict], min_count: int=MIN_COUNT):
+
+    # `grams` in count_stream order, n-gram sets the corpus doesn't have stay out
+    names = ['1-grams', '2-grams', '3-grams', 'skip-grams'] + [str(n) + '-grams' for n in range(4, len(grams))]
+
+    merged = dict(data)
+    for name, counts in zip(names, grams):
+        if not name in data:
+            continue
+
+        total = Counter(data[name])
+        total.update(counts)
+        if name[0] in '45':
+            total = prune(total, min_count)
+
+        merged[name] = dict(sorted(total.items(), key=lambda x: x[1], reverse=True))
+
+    return merged
+
+
+def get_delta(data: dict, merged: dict):
+
+    # the counts appending added, pruned 4- and 5-grams that are now common enough count in full
+    delta = {}
+    for name, counts in merged.items():
+        if name.endswith('-grams'):
+            old = data.get(name, {})
+            delta[name] = {seq: count - old.get(seq, 0) for seq, count in counts.items() if count != old.get(seq, 0)}
+
+    return delta
+
+
+def update_cache(conn, corpus_hash: str, path: str, delta: dict):
+
+    # raw sums are sums over n-grams, so the appended corpus's are the old ones plus the delta's
+    info = store.get_corpus(conn, path)
+    version = analyzer.get_results_version()
+
+    rows = store.get_corpus_raws(conn, corpus_hash, store.ALL_THUMBS, version)
+    if rows:
+        layouts = [layout.parse_tokens(row['tokens']) for row in rows]
+        for row, raw in zip(rows, analyzer.get_raw_batch(layouts, delta)):
+            analyzer.add_sums(row['raw'], raw)
+
+        for thumb in analyzer.MODES:
+            store.put_results(conn, info['hash'], {row['hash']: analyzer.get_metrics(row['raw'], thumb) for row in rows}, thumb, version)
+        store.put_raws(conn, info['hash'], rows, store.ALL_THUMBS, version)
+
+    return len(rows)
+
+
+def get_kind(data: dict):
+
+    # files from before the kind was recorded are told apart by where `wordlist` reads its lists
+    return data.get('kind', 'wordlist' if data['file'].startswith('wordlists/') else 'text')
+
+
+def append_data(path: str, file: str, cachedir: str, chunk_lines: int=CHUNK_LINES, min_count: int=None):
+
+    # binary corpora are merged in their json form and saved again
+    data = corpus.load(path)
+    if path.endswith('.bin'):
+        data = dict({name: data[name] for name in ['file'] + corpus.META if name in data}, **corpus.decode(data['arrays']))
+
+    # raw text counts would be mixed into counts on another scale
+    if get_kind(data) == 'wordlist':
+        raise ValueError(path + ' was built from a wordlist, rebuild it with the text instead of appending to it')
+
+    # 4- and 5-grams pruned at another count would need the ones under it taken out again,
+    # files that don't record it were counted with the default
+    if get_max_n(data) > 3:
+        pruned = data.get('min-count', MIN_COUNT)
+        if min_count is None:
+            min_count = pruned
+        elif min_count != pruned:
+            raise ValueError(path + ' was counted with --min-count ' + str(pruned) + ', append with the same or rebuild it')
+        data['min-count'] = min_count
+
+    merged = merge_data(data, count_stream(file, chunk_lines, max_n=get_max_n(data)), min_count)
+    delta = get_delta(data, merged)
+
+    # the layouts scored on the corpus as it was are carried over
+    conn = None
+    if os.path.isfile(os.path.join(cachedir, 'results.db')):
+        conn = store.connect(cachedir)
+        corpus_hash = store.get_corpus(conn, path)['hash']
+
+    if path.endswith('.bin'):
+        corpus.save(path + '.tmp', merged)
+        os.chmod(path + '.tmp', store.get_mode(path))
+        os.replace(path + '.tmp', path)
+    else:
+        store.write_file(path, json.dumps(merged, indent=4))
+
+    updated = 0
+    if conn:
+        updated = update_cache(conn, corpus_hash, path, delta)
+        conn.close()
+
+    added = len([seq for seq in delta['3-grams'] if not seq in data['3-grams']])
+
+    return delta, added, updated
+
+
+def write_data(file: str, results: dict):
+
+    # the json.dumps(results, indent=4) layout, written pair by pair so spilled counts are never all in memory
+    with open(file, 'w') as f:
+        f.write('{')
+        for i, (name, value) in enumerate(results.items()):
+            f.write((',' if i else '') + '\n    ' + json.dumps(name) + ': ')
+            if isinstance(value, (str, int)):
+                f.write(json.dumps(value))
+                continue
+
+            f.write('{')
+            empty = True
+            for seq, count in (value.items() if isinstance(value, dict) else value):
+                f.write(('' if empty else ',') + '\n        ' + json.dumps(seq) + ': ' + json.dumps(count))
+                empty = False
+            f.write('}' if empty else '\n    }')
+        f.write('\n}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='generate n-gram data for the analyzer')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    wordlist = commands.add_parser('wordlist', help='build data from a wordlist in wordlists/')
+    wordlist.add_argument('name')
+    wordlist.add_argument('-o', '--output')
+    wordlist.add_argument('--workers', type=int, default=1, help='count shards of the wordlist on this many processes')
+
+    text = commands.add_parser('text', help='stream a plain text corpus of any size')
+    text.add_argument('input')
+    text.add_argument('-o', '--output', required=True)
+    text.add_argument('--chunk', type=int, default=CHUNK_LINES, help='lines per chunk')
+    text.add_argument('--spill', help='directory for sorted runs of partial counts, merged into the output on one process')
+    text.add_argument('--max-keys', type=int, default=MAX_KEYS, help='distinct n-grams held before spilling')
+    text.add_argument('--workers', type=int, default=1, help='count shards of the input on this many processes')
+    text.add_argument('--max-n', type=int, default=MAX_N, choices=[3, 4, 5], help='also count 4- and 5-grams')
+    text.add_argument('--min-count', type=int, default=MIN_COUNT, help='drop rarer 4- and 5-grams')
+
+    append = commands.add_parser('append', help='add the n-grams of a plain text to an existing corpus')
+    append.add_argument('corpus', help='a data file, or the name of one in --datadir')
+    append.add_argument('input')
+    append.add_argument('--datadir', default='data')
+    append.add_argument('--cachedir', default='cache', help='scored layouts to carry over to the new counts')
+    append.add_argument('--chunk', type=int, default=CHUNK_LINES, help='lines per chunk')
+    append.add_argument('--min-count', type=int, help='must match the one the corpus was counted with, which is the default')
+
+    args = parser.parse_args()
+
+    if args.command == 'wordlist':
+        results = {
+            'file': 'wordlists/' + args.name + '.json',
+            'kind': 'wordlist',
+            '1-grams': {},
+            '3-grams': {},
+        }
+
+        if args.workers > 1:
+            results['1-grams'], results['3-grams'] = get_wordlist_parallel(results['file'], args.workers)
+        else:
+            results['1-grams'] = get_monograms(results['file'])
+            results['3-grams'] = get_trigrams(results['file'])
+
+        results['2-grams'], results['skip-grams'] = get_pairs(results['3-grams'])
+        write_data(args.output or args.name + '.json', results)
+
+    elif args.command == 'text':
+        if args.spill and args.workers > 1:
+            parser.error('--spill counts on one process, it can\'t be used with --workers')
+        if args.spill and not os.path.isdir(args.spill):
+            os.makedirs(args.spill)
+
+        if args.workers > 1:
+            part = count_parallel(args.input, args.workers, args.chunk, args.max_n)
+            grams = [dict(total.most_common()) for total in part['grams']]
+        else:
+            grams = count_stream(args.input, args.chunk, args.spill, args.max_keys, args.max_n)
+
+        results = {
+            'file': args.input,
+            'kind': 'text',
+        }
+        if args.max_n > 3:
+            results['min-count'] = args.min_count
+        results.update({
+            '1-grams': grams[0],
+            '2-grams': grams[1],
+            '3-grams': grams[2],
+            'skip-grams': grams[3],
+        })
+        for n, counts in zip(range(4, args.max_n + 1), grams[4:]):
+            results[str(n) + '-grams'] = prune(counts, args.min_count)
+
+        write_data(args.output, results)
+
+    elif args.command == 'append':
+        path = args.corpus if os.path.isfile(args.corpus) else corpus.get_path(args.datadir, args.corpus)
+        try:
+            delta, added, updated = append_data(path, args.input, args.cachedir, args.chunk, args.min_count)
+        except ValueError as e:
+            parser.error(str(e))
+
+        print(
+            'updated', len(delta['3-grams']), 'trigram counts of', path, '(' + str(added), 'new),',
+            'rescored', updated, 'cached layouts on them'
+        )
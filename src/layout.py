@@ -2,33 +2,247 @@ import json
 import hashlib
 import glob
 import os
-from typing import Dict
+from array import array
+from collections.abc import Mapping
+from typing import Dict, List
 
 JSON = Dict[str, any]
 
+template = None
+parsed = {}
 
-def load_file(filename: str):
-    
-    fingers = ['LP', 'LR', 'LM', 'LI', 'RI', 'RM', 'RR', 'RP']
+# same order as analyzer.FINGERS, layouts store fingers as positions in it
+FINGERS = ['LP', 'LR', 'LM', 'LI', 'LT', 'RT', 'RI', 'RM', 'RR', 'RP']
 
-    shifted = dict(zip(
-        "abcdefghijklmnopqrstuvwxyz,./;'-=[]",
-        "ABCDEFGHIJKLMNOPQRSTUVWXYZ<>?:\"_+{}"
-    ))
+# the fingers of the index rows in layout files, 0 to 7
+FILE_FINGERS = [FINGERS.index(finger) for finger in ['LP', 'LR', 'LM', 'LI', 'RI', 'RM', 'RR', 'RP']]
+
+# every finger and the same finger of the other hand
+MIRRORED = dict(zip(FINGERS, reversed(FINGERS)))
+
+# every character any layout has gets one id, shared by all layouts in the process
+chars = []
+char_ids = {}
+
+
+def get_char_id(char: str):
+
+    if not char in char_ids:
+        char_ids[char] = len(chars)
+        chars.append(char)
+
+    return char_ids[char]
+
+
+class Layout:
+
+    # finger, row, col and shift of every char id in one signed byte each, -1 where there is no key,
+    # and the tokens they were parsed from
+    __slots__ = ['name', 'file', 'hash', 'mirror', 'tokens', 'fingers', 'rows', 'cols', 'shifts']
+
+    def __init__(self, name: str=''):
+
+        self.name = name
+        self.file = None
+        self.hash = None
+        self.mirror = None
+        self.tokens = None
+        self.fingers = array('b')
+        self.rows = array('b')
+        self.cols = array('b')
+        self.shifts = array('b')
+
+    def set_key(self, char: str, finger: int, row: int=-1, col: int=-1, shift: bool=False):
+
+        char_id = get_char_id(char)
+        if char_id >= len(self.fingers):
+            padding = array('b', [-1]) * (char_id + 1 - len(self.fingers))
+            for values in [self.fingers, self.rows, self.cols, self.shifts]:
+                values.extend(padding)
+
+        self.fingers[char_id] = finger
+        self.rows[char_id] = row
+        self.cols[char_id] = col
+        self.shifts[char_id] = shift
+
+    def get_ids(self):
+
+        return [char_id for char_id, finger in enumerate(self.fingers) if finger >= 0]
+
+    def copy(self):
+
+        # the arrays are shared, parsed layouts are never changed in place
+        keys = Layout(self.name)
+        for name in self.__slots__:
+            setattr(keys, name, getattr(self, name))
+
+        return keys
+
+    def __getitem__(self, name: str):
+
+        # the dict form, keys['keys'][char]['finger'] and the like
+        if name == 'keys':
+            return KeysView(self)
+        if not name in self.__slots__:
+            raise KeyError(name)
+
+        return getattr(self, name)
+
+    def __setitem__(self, name: str, value):
 
-    keys = json.load(open('src/static/TEMPLATE.json', 'r'))
-    keys['file'] = filename
+        setattr(self, name, value)
+
+    def __getstate__(self):
+
+        # char ids differ between processes, so layouts travel with their chars
+        return {
+            'info': [self.name, self.file, self.hash, self.mirror, self.tokens],
+            'keys': [
+                (chars[char_id], self.fingers[char_id], self.rows[char_id], self.cols[char_id], self.shifts[char_id])
+                for char_id in self.get_ids()
+            ],
+        }
+
+    def __setstate__(self, state: JSON):
+
+        self.__init__()
+        self.name, self.file, self.hash, self.mirror, self.tokens = state['info']
+        for key in state['keys']:
+            self.set_key(*key)
+
+
+class KeysView(Mapping):
+
+    __slots__ = ['source']
+
+    def __init__(self, keys: Layout):
+
+        self.source = keys
+
+    def __getitem__(self, char: str):
+
+        char_id = char_ids.get(char, len(self.source.fingers))
+        if char_id >= len(self.source.fingers) or self.source.fingers[char_id] < 0:
+            raise KeyError(char)
+
+        key = {'finger': FINGERS[self.source.fingers[char_id]]}
+        if self.source.rows[char_id] >= 0:
+            key['row'] = self.source.rows[char_id]
+            key['col'] = self.source.cols[char_id]
+        key['shift'] = bool(self.source.shifts[char_id])
+
+        return key
+
+    def __iter__(self):
+
+        return (chars[char_id] for char_id in self.source.get_ids())
+
+    def __len__(self):
+
+        return len(self.source.get_ids())
+
+
+def get_tokens(filename: str):
 
     with open(filename, 'r') as f:
+        name = ''
         tokens = []
         for i, line in enumerate(f.readlines()):
             if i == 0:
-                keys['name'] = ' '.join(line.split())
+                name = ' '.join(line.split())
             else:
                 tokens.append(line.split())
 
+    return name, tokens
+
+
+def split_token(token: str):
+
+    shifted = dict(zip(
+        "abcdefghijklmnopqrstuvwxyz,./;'-=[]",
+        "ABCDEFGHIJKLMNOPQRSTUVWXYZ<>?:\"_+{}"
+    ))
+
+    if len(token) == 2:
+        return token[0], token[1]
+    elif token in shifted:
+        return token, shifted[token]
+    else:
+        return token, None
+
+
+def get_template():
+
+    global template
+
+    if template is None:
+        saved = json.load(open('src/static/TEMPLATE.json', 'r'))
+        template = Layout(saved['name'])
+        for char, key in saved['keys'].items():
+            template.set_key(char, FINGERS.index(key['finger']), shift=key['shift'])
+
+    # a copy with arrays of its own
+    keys = Layout(template.name)
+    for name in ['fingers', 'rows', 'cols', 'shifts']:
+        setattr(keys, name, array('b', getattr(template, name)))
+
+    return keys
+
+
+def get_hash(tokens: List[List[str]]):
+
     hashstr = '-'.join([val for sublist in tokens for val in sublist])
-    keys['hash'] = hashlib.md5(hashstr.encode()).hexdigest()
+    return hashlib.md5(hashstr.encode()).hexdigest()
+
+
+def get_key(keys: Layout, mirrored: bool=False):
+
+    # the analyzer only sees each character's finger, row and column, and compares columns by
+    # their distance, so spellings of the same keys and layouts with columns reversed share a key
+    ids = keys.get_ids()
+    names = [MIRRORED[FINGERS[keys.fingers[i]]] if mirrored else FINGERS[keys.fingers[i]] for i in ids]
+
+    forms = []
+    for step in [1, -1]:
+        cols = [step * keys.cols[i] for i in ids if keys.rows[i] >= 0]
+        offset = min(cols, default=0)
+
+        forms.append(sorted(
+            [chars[i], finger, keys.rows[i], step * keys.cols[i] - offset if keys.rows[i] >= 0 else -1]
+            for i, finger in zip(ids, names)
+        ))
+
+    return hashlib.md5(json.dumps(min(forms), separators=(',', ':')).encode()).hexdigest()
+
+
+def get_parsed(tokens: List[List[str]]):
+
+    # files with the same tokens share one parsed layout
+    token_hash = get_hash(tokens)
+    if not token_hash in parsed:
+        keys = parse_tokens(tokens)
+        keys.hash = get_key(keys)
+        keys.mirror = get_key(keys, True)
+        keys.tokens = tokens
+        parsed[token_hash] = keys
+
+    return parsed[token_hash]
+
+
+def load_file(filename: str):
+
+    name, tokens = get_tokens(filename)
+
+    keys = get_parsed(tokens).copy()
+    keys.file = filename
+    keys.name = name
+
+    return keys
+
+
+def parse_tokens(tokens: List[List[str]]):
+
+    keys = get_template()
 
     chars = tokens[:len(tokens) // 2]
     indexes = tokens[len(tokens) // 2:]
@@ -40,37 +254,58 @@ def load_file(filename: str):
 
     for i, keymap in enumerate(rows):
         for j, item in enumerate(keymap):
-            finger = fingers[int(item[1])]
+            finger = FILE_FINGERS[int(item[1])]
+            primary, shift = split_token(item[0])
 
-            primary = ''
-            shift = ''
+            keys.set_key(primary, finger, i, j, False)
+            if shift:
+                keys.set_key(shift, finger, i, j, True)
 
-            if len(item[0]) == 2:
-                primary = item[0][0]
-                shift = item[0][1]
-            else:
-                primary = item[0]
-                if item[0] in shifted:
-                    shift = shifted[item[0]]
-                else:
-                    shift = None
-
-            keys['keys'][primary] = {
-                'finger': finger,
-                'row': i,
-                'col': j,
-                'shift': False,
+    return keys
+
+
+def save_file(filename: str, name: str, tokens: List[List[str]]):
+
+    chars = tokens[:len(tokens) // 2]
+    indexes = tokens[len(tokens) // 2:]
+
+    with open(filename, 'w') as f:
+        f.write(name + '\n')
+        for row in chars:
+            f.write('  '.join(row) + '\n')
+        for row in indexes:
+            f.write(' '.join(row) + '\n')
+
+
+def scan_dir(dirname: str, index: JSON=None):
+
+    # name and hash of every layout, only reading files changed since `index`
+    index = index or {}
+
+    entries = []
+    for filename in glob.glob(dirname + "/*"):
+        stat = os.stat(filename)
+        entry = index.get(filename)
+
+        if (
+            not entry or
+            entry['mtime'] != stat.st_mtime_ns or
+            entry['size'] != stat.st_size
+        ):
+            name, tokens = get_tokens(filename)
+            keys = get_parsed(tokens)
+            entry = {
+                'file': filename,
+                'name': name,
+                'hash': keys['hash'],
+                'mirror': keys['mirror'],
+                'mtime': stat.st_mtime_ns,
+                'size': stat.st_size,
             }
 
-            if shift:
-                keys['keys'][shift] = {
-                    'finger': finger,
-                    'row': i,
-                    'col': j,
-                    'shift': True,
-                }   
+        entries.append(entry)
 
-    return keys
+    return entries
 
 
 def load_dir(dirname: str):
@@ -81,7 +316,7 @@ def load_dir(dirname: str):
     return layouts
 
 
-def pretty_print(filename: str, config: JSON):
+def render(filename: str, colors: JSON, monograms: JSON):
 
     shifted = dict(zip(
         "abcdefghijklmnopqrstuvwxyz,./;'-=[]",
@@ -89,27 +324,14 @@ def pretty_print(filename: str, config: JSON):
     ))
 
     # get tokens
-    keys = {}
-    with open(filename, 'r') as f:
-        tokens = []
-        for i, line in enumerate(f.readlines()):
-            if i == 0:
-                keys['name'] = ' '.join(line.split())
-            else:
-                tokens.append(line.split())
-    
-    # theme
-    themepath = os.path.join(config['themedir'], config['theme'] + '.json')
-    colors = json.load(open(themepath, 'r'))['colors']
-
-    # 1 gram data
-    datapath = os.path.join(config['datadir'], config['datafile'] + '.json')
-    data = json.load(open(datapath, 'r'))['1-grams']
+    name, tokens = get_tokens(filename)
 
+    data = dict(monograms)
     data[' '] = 0
     data_total = sum(data.values())
 
     # print characters
+    out = []
     chars = tokens[:len(tokens) // 2]
     for row in chars:
         for i, key in enumerate(row):
@@ -121,13 +343,15 @@ def pretty_print(filename: str, config: JSON):
             percent /= data_total
 
             if percent > .05:
-                print('\033[38;5;' + colors['highest'] + 'm' + key[0] + '\033[0m', end=' ')
+                out.append('\033[38;5;' + colors['highest'] + 'm' + key[0] + '\033[0m ')
             elif percent > .02:
-                print('\033[38;5;' + colors['high'] + 'm' + key[0] + '\033[0m', end=' ')
+                out.append('\033[38;5;' + colors['high'] + 'm' + key[0] + '\033[0m ')
             else:
-                print('\033[38;5;' + colors['base'] + 'm' + key[0] + '\033[0m', end=' ')
+                out.append('\033[38;5;' + colors['base'] + 'm' + key[0] + '\033[0m ')
 
             if i == len(row) // 2 - 1:
-                print('', end=' ')
-        print()
+                out.append(' ')
+        out.append('\n')
+
+    return ''.join(out)
     
\ No newline at end of file
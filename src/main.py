@@ -3,11 +3,20 @@ import os
 import json
 import shutil
 import copy
-import layout, analyzer
+import bisect
+import io
+import contextlib
+import numpy as np
+import layout, analyzer, optimize, corpus, store, server, timing, cli
 from typing import Dict, List
 
 JSON = Dict[str, any]
 
+# kept for the life of the process, which matters when serving
+corpora = {}
+cached = {}
+cached_raws = {}
+
 
 def init_config():
     
@@ -15,27 +24,66 @@ def init_config():
         config = json.load(open('init-config.json', 'r'))
     else:
         config = json.load(open(os.path.join('src', 'static', 'config-init.json'), 'r'))
-    layouts = layout.load_dir(config['layoutdir'])
-
-    for keys in layouts:
-        config['layouts'][keys['name'].lower()] = True
+    for entry in scan_layouts(config):
+        config['layouts'][entry['name'].lower()] = True
 
     return config
 
 
-def get_layout_percent(item: JSON, metric: str, results: JSON):
+def scan_layouts(config: JSON):
+
+    conn = store.connect(config['cachedir'])
+
+    index = store.get_index(conn)
+    entries = layout.scan_dir(config['layoutdir'], index)
+    store.put_index(conn, entries, index)
+
+    conn.close()
+
+    return entries
 
-    wins = 0
-    for result in results['data']:
-        if item['metrics'][metric] > result['metrics'][metric]:
-            wins += 1
-    return wins / len(results['data'])
 
+def get_data(datapath: str):
 
-def print_color(item: JSON, metric: str, data: JSON, config: JSON, isPercent: bool=True):
+    # reloaded only when the file changes
+    stamp = os.stat(datapath).st_mtime_ns
+    if not datapath in corpora or corpora[datapath][0] != stamp:
+        corpora[datapath] = (stamp, corpus.load(datapath))
+
+    return corpora[datapath][1]
+
+
+def get_percentiles(results: JSON):
+
+    # every metric's values sorted once, ranks are then a bisect away
+    if not results['data']:
+        return {}
+
+    return {
+        metric: sorted(item['metrics'][metric] for item in results['data'])
+        for metric in results['data'][0]['metrics']
+    }
+
+
+def get_layout_percent(item: JSON, metric: str, percentiles: JSON):
+
+    # share of layouts with a strictly lower value
+    values = percentiles[metric]
+    return bisect.bisect_left(values, item['metrics'][metric]) / len(values)
+
+
+def get_render(results: JSON, config: JSON):
+
+    return {
+        'colors': json.load(open(os.path.join(config['themedir'], config['theme'] + '.json'), 'r'))['colors'],
+        'percentiles': get_percentiles(results),
+    }
+
+
+def format_color(item: JSON, metric: str, render: JSON, isPercent: bool=True):
 
     # get percentage of layouts worse
-    percent = get_layout_percent(item, metric, data)
+    percent = get_layout_percent(item, metric, render['percentiles'])
 
     # get string
 
@@ -44,85 +92,276 @@ def print_color(item: JSON, metric: str, data: JSON, config: JSON, isPercent: bo
     else:
         string = "{0:.2f}".format(item['metrics'][metric]).rjust(6, ' ') + ' '
 
-    # color printing based on percentage
-    colors = json.load(open(os.path.join(config['themedir'], config['theme'] + '.json'), 'r'))['colors']
+    # color based on percentage
+    colors = render['colors']
     if percent > .9:
-        print('\033[38;5;' + colors['highest'] + 'm' + string + '\033[0m', end=' ')
+        color = colors['highest']
     elif percent > .7:
-        print('\033[38;5;' + colors['high'] + 'm' + string + '\033[0m', end=' ')
+        color = colors['high']
 
     elif percent < .1:
-        print('\033[38;5;' + colors['lowest'] + 'm' + string + '\033[0m', end=' ')
+        color = colors['lowest']
     elif percent < .3:
-        print('\033[38;5;' + colors['low'] + 'm' + string + '\033[0m', end=' ')
+        color = colors['low']
     else:
-        print('\033[38;5;' + colors['base'] + 'm' + string + '\033[0m', end=' ')
+        color = colors['base']
+
+    return '\033[38;5;' + color + 'm' + string + '\033[0m '
+
 
+def get_overlaps(intervals: JSON, metrics: List[str]):
 
-def get_results(config: JSON):
+    # layouts whose interval on any of `metrics` overlaps another layout's
+    hashes = list(intervals)
+    flagged = np.zeros(len(hashes), dtype=bool)
+    for metric in metrics:
+        low = np.array([intervals[layout_hash][metric][0] for layout_hash in hashes])
+        high = np.array([intervals[layout_hash][metric][1] for layout_hash in hashes])
+
+        overlap = (low[:, None] <= high[None, :]) & (low[None, :] <= high[:, None])
+        np.fill_diagonal(overlap, False)
+        flagged |= overlap.any(axis=1)
+
+    return {layout_hash for layout_hash, flag in zip(hashes, flagged) if flag}
+
+
+def score_raws(layouts: List[JSON], datapath: str, jobs: int):
+
+    # one batch, or one batch per worker
+    if len(layouts) > 1 and jobs > 1:
+        return analyzer.get_raw_parallel(layouts, datapath, analyzer.THUMBS, min(jobs, len(layouts)))
+    elif layouts:
+        return analyzer.get_raw_batch(layouts, get_data(datapath))
+
+    return []
+
+
+def put_scored(conn, corpus_hash: str, layouts: List[JSON], raws: JSON, version: str):
+
+    # metrics of newly scored layouts in every thumb mode, so switching modes needs no rescoring,
+    # and their raw sums with the tokens that were scored, not what the file holds by now
+    if layouts:
+        for thumb in analyzer.MODES:
+            scored = {keys['hash']: analyzer.get_metrics(raws[keys['hash']], thumb) for keys in layouts}
+            store.put_results(conn, corpus_hash, scored, thumb, version)
+            cached.setdefault((corpus_hash, thumb, version), {}).update(scored)
+
+        store.put_raws(conn, corpus_hash, [
+            {'hash': keys['hash'], 'path': keys['file'], 'tokens': keys['tokens'], 'raw': raws[keys['hash']]}
+            for keys in layouts
+        ], store.ALL_THUMBS, version)
+
+
+def get_mirrored(entries: List[JSON], found: JSON, mirrors: JSON, mirror):
+
+    # layouts whose mirror image is known take its metrics or raw sums with the hands swapped
+    return {
+        entry['hash']: mirror(mirrors[entry['mirror']])
+        for entry in entries
+        if not entry['hash'] in found and entry['mirror'] in mirrors
+    }
+
+
+def get_blend(config: JSON, entries: List[JSON], conn, jobs: int=1):
+
+    thumb = config['thumb-space']
+    version = analyzer.get_results_version()
+    total = sum(config['blend'].values())
+    symmetric = analyzer.is_symmetric()
+
+    # every corpus's raw sums of every layout, scoring only the ones never stored
+    files = []
+    blended = []
+    for name, weight in config['blend'].items():
+        datapath = corpus.get_path(config['datadir'], name)
+        info = store.get_corpus(conn, datapath)
+
+        raws = cached_raws.setdefault((info['hash'], version), {})
+        unknown = [entry['hash'] for entry in entries if not entry['hash'] in raws]
+        if symmetric:
+            unknown += [entry['mirror'] for entry in entries if not entry['hash'] in raws and not entry['mirror'] in raws]
+        if unknown:
+            raws.update(store.get_raws(conn, info['hash'], unknown, store.ALL_THUMBS, version))
+        if symmetric:
+            raws.update(get_mirrored(entries, raws, raws, analyzer.mirror_raw))
+
+        # of a layout and its mirror image only one is scored
+        missing = {}
+        for entry in entries:
+            if not entry['hash'] in raws and not (symmetric and entry['mirror'] in missing):
+                missing[entry['hash']] = entry['file']
+
+        missing = [layout.load_file(filename) for filename in missing.values()]
+        raws.update(zip([keys['hash'] for keys in missing], score_raws(missing, datapath, jobs)))
+        put_scored(conn, info['hash'], missing, raws, version)
+        if symmetric:
+            raws.update(get_mirrored(entries, raws, raws, analyzer.mirror_raw))
+
+        files.append("{:.0%} ".format(weight / total) + info['file'])
+        blended.append((raws, weight / total))
+
+    results = {
+        'file': ' + '.join(files),
+        'data': [],
+    }
+
+    # changing the weights is only arithmetic on the stored sums
+    for entry in entries:
+        raw = analyzer.blend_raws([raws[entry['hash']] for raws, weight in blended], [weight for raws, weight in blended], thumb)
+        results['data'].append({
+            'name': entry['name'],
+            'file': entry['file'],
+            'hash': entry['hash'],
+            'mirror': entry['mirror'],
+            'sort': 0,
+            'metrics': analyzer.get_metrics(raw, thumb),
+        })
+
+    return results
+
+
+def get_results(config: JSON, jobs: int=1, approx: bool=False):
 
     # open/create results cache
-    cachefile = os.path.join(config['cachedir'], 'cached-' + config['datafile'] + '.json')
+    conn = store.connect(config['cachedir'])
 
-    if not os.path.isdir(config['cachedir']):
-        os.mkdir(config['cachedir'])
+    # layouts are only parsed when they need scoring
+    index = store.get_index(conn)
+    entries = layout.scan_dir(config['layoutdir'], index)
+    store.put_index(conn, entries, index)
 
-    if os.path.isfile(cachefile):
-        cache = json.load(open(cachefile, 'r'))
-    else:   
-        cache = {
-            'file': config['datafile'],
-            'data': {}
-        }
+    # a blend of corpora is combined from each one's raw sums
+    if config.get('blend'):
+        results = get_blend(config, entries, conn, jobs)
+        conn.close()
+        sort_results(results, config)
+        return results
 
-    layouts = layout.load_dir(config['layoutdir'])
-    data = json.load(open(os.path.join(config['datadir'], config['datafile'] + '.json'), 'r'))
+    datapath = corpus.get_path(config['datadir'], config['datafile'])
+    info = store.get_corpus(conn, datapath)
+    version = analyzer.get_results_version()
 
     results = {
-        'file': data['file'],
+        'file': info['file'],
         'data': []
     }
 
-    for keys in layouts:
+    # results are keyed by layout content, not name, and a mirror image's results
+    # under the other thumb serve a layout with the hands swapped
+    symmetric = analyzer.is_symmetric()
+    cache = cached.setdefault((info['hash'], config['thumb-space'], version), {})
+    mirrors = cached.setdefault((info['hash'], analyzer.MIRRORED.get(config['thumb-space'], config['thumb-space']), version), {})
+
+    unknown = [entry['hash'] for entry in entries if not entry['hash'] in cache]
+    if unknown:
+        cache.update(store.get_results(conn, info['hash'], unknown, config['thumb-space'], version))
+    if unknown and symmetric:
+        mirrors.update(store.get_results(
+            conn, info['hash'], [entry['mirror'] for entry in entries if not entry['hash'] in cache],
+            analyzer.MIRRORED.get(config['thumb-space'], config['thumb-space']), version
+        ))
+        cache.update(get_mirrored(entries, cache, mirrors, analyzer.mirror_metrics))
+
+    missing = {entry['hash']: entry['file'] for entry in entries if not entry['hash'] in cache}
+    missing = [layout.load_file(filename) for filename in missing.values()]
+
+    if timing.enabled:
+        timing.count('cache hits (memory)', len(entries) - len(unknown))
+        timing.count('cache hits (store)', len(unknown) - len(missing))
+        timing.count('cache misses', len(missing))
+
+    # an edited layout is rescored from the raw sums of its previous keys
+    raws = {}
+    for keys in missing:
+        base = store.get_base(conn, info['hash'], keys['file'], store.ALL_THUMBS, version)
+        if base:
+            raw = analyzer.rescore_raw(layout.parse_tokens(base['tokens']), keys, base['raw'], get_data(datapath))
+            if raw:
+                raws[keys['hash']] = raw
+
+    if timing.enabled:
+        timing.count('delta rescored', len(raws))
+
+    rest = [keys for keys in missing if not keys['hash'] in raws]
+
+    # sampled estimates are kept unless their intervals overlap on a sort metric, those are scored exactly
+    estimates = {}
+    if approx and rest:
+        sampled, intervals = analyzer.get_approx_batch(rest, get_data(datapath), config['thumb-space'])
+        if intervals is None:
+            raws.update(zip([keys['hash'] for keys in rest], sampled))
+        else:
+            estimates = {
+                keys['hash']: {'metrics': analyzer.get_metrics(raw, config['thumb-space']), 'intervals': interval}
+                for keys, raw, interval in zip(rest, sampled, intervals)
+            }
+
+            exact = {**cache, **{layout_hash: analyzer.get_metrics(raw, config['thumb-space']) for layout_hash, raw in raws.items()}}
+            ranges = {entry['hash']: {metric: [value, value] for metric, value in exact[entry['hash']].items()} for entry in entries if entry['hash'] in exact}
+            ranges.update({layout_hash: estimate['intervals'] for layout_hash, estimate in estimates.items()})
+
+            sort = list(config['sort']) if type(config['sort']) == dict else []
+            refine = get_overlaps(ranges, sort)
+            estimates = {layout_hash: estimate for layout_hash, estimate in estimates.items() if not layout_hash in refine}
+
+        rest = [keys for keys in rest if not keys['hash'] in estimates and not keys['hash'] in raws]
+
+        if timing.enabled:
+            timing.count('approximated', len(estimates))
+
+    # of a layout and its mirror image only one is scored
+    if symmetric:
+        scored = set(raws)
+        unique = []
+        for keys in rest:
+            if not keys['mirror'] in scored:
+                unique.append(keys)
+                scored.add(keys['hash'])
+        rest = unique
+
+    raws.update(zip([keys['hash'] for keys in rest], score_raws(rest, datapath, jobs)))
+
+    # only new exact entries are written
+    put_scored(conn, info['hash'], [keys for keys in missing if keys['hash'] in raws], raws, version)
+    if symmetric:
+        mirrored = get_mirrored(entries, cache, mirrors, analyzer.mirror_metrics)
+        cache.update(mirrored)
+
+        if timing.enabled:
+            timing.count('mirrored', len(mirrored))
+
+    conn.close()
+
+    for entry in entries:
         item = {
-            'name': keys['name'],
-            'file': keys['file'],
+            'name': entry['name'],
+            'file': entry['file'],
+            'hash': entry['hash'],
+            'mirror': entry['mirror'],
             'sort': 0,
-            'metrics': {},
         }
 
-        # add key if it doesn't exist or contains a hash mismatch
-        if (
-            not keys['name'] in cache['data'] or
-            keys['hash'] != cache['data'][keys['name']]['hash']
-        ):
-            cache['data'][keys['name']] = {
-                'hash': keys['hash']
-            }
-
-        # get stats
-        if not config['thumb-space'] in cache['data'][item['name']]:
-            cache['data'][item['name']][config['thumb-space']] = analyzer.get_results(keys, data, config)
-
-        item['metrics'] = cache['data'][item['name']][config['thumb-space']]
+        if entry['hash'] in cache:
+            item['metrics'] = cache[entry['hash']]
+        else:
+            item['metrics'] = estimates[entry['hash']]['metrics']
+            item['intervals'] = estimates[entry['hash']]['intervals']
     
         results['data'].append(item)
         
     sort_results(results, config)
 
-    # write cache
-    with open(cachefile, 'w') as f:
-        f.write(json.dumps(cache, indent=4)) 
-
     return results
 
 
 def sort_results(results: JSON, config: JSON):
 
+    percentiles = get_percentiles(results)
+
     # calulate sort criteria
     for item in results['data']:
         for sort in config['sort']:
-            percent = get_layout_percent(item, sort, results)
+            percent = get_layout_percent(item, sort, percentiles)
             if str(config['sort'][sort])[0] == '-':
                 value = 1 - percent
             else:
@@ -137,40 +376,78 @@ def sort_results(results: JSON, config: JSON):
         results['data'] = sorted(results['data'], key=lambda x : x['sort'], reverse=config['sort-high'])
 
 
+def get_pareto(points: List[tuple]):
+
+    # indices of the points no other point matches or beats on every axis, higher is better
+    if points and len(points[0]) > 3:
+        values = np.array(points)
+        return [i for i, value in enumerate(values) if not ((values >= value).all(1) & (values > value).any(1)).any()]
+
+    # any dominating point comes before the one it dominates in descending order, so one sweep
+    # over a staircase of the (y, z) seen so far finds them, with x of the first point on each step
+    points = [tuple(point) + (0,) * (3 - len(point)) for point in points]
+    order = sorted(range(len(points)), key=lambda i: points[i], reverse=True)
+
+    front = []
+    ys, zs, xs = [], [], []
+    for i in order:
+        x, y, z = points[i]
+
+        # the first step at or above y has the highest z of those, an equal one is a duplicate
+        step = bisect.bisect_left(ys, y)
+        if step < len(ys) and zs[step] >= z and (ys[step], zs[step], xs[step]) != (y, z, x):
+            continue
+
+        front.append(i)
+        if step < len(ys) and (ys[step], zs[step]) == (y, z):
+            continue
+
+        # the steps below this one in both y and z are gone
+        low = step
+        while low and zs[low - 1] <= z:
+            low -= 1
+        high = step + (step < len(ys) and ys[step] == y)
+
+        ys[low:high] = [y]
+        zs[low:high] = [z]
+        xs[low:high] = [x]
+
+    return front
+
+
 def show_results(results: JSON, config: JSON):
 
+    render = get_render(results, config)
+    out = []
+
     # print metadata
-    print(results['file'].upper())
+    out.append(results['file'].upper() + '\n')
 
     if config['filter']:
-        print("filter by:", end='   ')
+        out.append("filter by:   ")
         for filter in config['filter']:
-            print(
-                filter, 
-                "{:.2%}".format(config['filter'][filter]),
-                end='   '
-            )
-        print()
+            out.append(filter + ' ' + "{:.2%}".format(config['filter'][filter]) + '   ')
+        out.append('\n')
 
     if config['sort']:
-        print("sort by:", end='   ')
+        out.append("sort by:   ")
         for sort in config['sort']:
-            print(
-                sort, 
-                "{:.0%}".format(config['sort'][sort]),
-                end='   '
-            )
-        print()
+            out.append(sort + ' ' + "{:.0%}".format(config['sort'][sort]) + '   ')
+        out.append('\n')
 
-    # print(("sort by " + config['sort'].upper() + ":").ljust(22, ' '), end=' ')
-    print(("thumb: " + config['thumb-space']).ljust(22, ' '), end=' ')
+    if config.get('pareto'):
+        out.append("pareto:   ")
+        for metric in config['pareto']:
+            out.append(('-' if config['pareto'][metric] < 0 else '') + metric + '   ')
+        out.append('\n')
 
+    out.append(("thumb: " + config['thumb-space']).ljust(22, ' ') + ' ')
 
     # print column names
-    for metric, value in flatten(config['columns']).items():
-        if value:
-            print(metric.rjust(8, ' '), end=' ')
-    print()
+    columns = [metric for metric, value in flatten(config['columns']).items() if value]
+    for metric in columns:
+        out.append(metric.rjust(8, ' ') + ' ')
+    out.append('\n')
 
     # get filters
     filters = []
@@ -184,7 +461,8 @@ def show_results(results: JSON, config: JSON):
 
         filters.append(filter)
 
-    # print rows
+    # get rows
+    rows = []
     for item in results['data']:
 
         if item['name'].lower() not in config['layouts']:
@@ -203,133 +481,193 @@ def show_results(results: JSON, config: JSON):
             if dir*(item['metrics'][name] - cutoff) < 0:
                 break
         else:
-            # print layout stats
-            print((item['name'] + '\033[38;5;250m' + ' ').ljust(36, '-') + '\033[0m', end=' ')
-            for metric, value in flatten(config['columns']).items():
-                if value:
-                    print_color(item, metric, results, config, metric not in ['roll-rt', 'oneh-rt'])
-            print()
+            rows.append(item)
+
+    # only the shown layouts that no other one beats on every pareto metric, in sort order
+    if config.get('pareto'):
+        front = get_pareto([
+            tuple(dir * item['metrics'][metric] for metric, dir in config['pareto'].items())
+            for item in rows
+        ])
+        rows = [rows[i] for i in sorted(front)]
+
+    # print rows
+    listed = set()
+    for item in rows:
+        # = marks the same keys as a layout above, <> their mirror image
+        mark = ''
+        if item['hash'] in listed:
+            mark = ' ='
+        elif item['mirror'] in listed:
+            mark = ' <>'
+        listed.add(item['hash'])
+
+        # print layout stats, ~ marks sampled estimates
+        out.append((item['name'] + (' ~' if 'intervals' in item else '') + mark + '\033[38;5;250m' + ' ').ljust(36, '-') + '\033[0m ')
+        for metric in columns:
+            out.append(format_color(item, metric, render, metric not in ['roll-rt', 'oneh-rt']))
+        out.append('\n')
+
+    sys.stdout.write(''.join(out))
 
 
 def print_layout(results: JSON, config: JSON):
 
-    print(results['file'].upper())
-    print(("thumb: " + config['thumb-space']).ljust(22, ' '))
+    render = get_render(results, config)
+    out = []
+
+    out.append(results['file'].upper() + '\n')
+    out.append(("thumb: " + config['thumb-space']).ljust(22, ' ') + '\n')
+
+    # 1 gram data for the key colors
+    monograms = None
 
     for item in [item for item in results['data'] if config['layouts'][item['name'].lower()] == True]:
-        
-        print()
+
+        if monograms is None:
+            monograms = get_data(corpus.get_path(config['datadir'], config['datafile']))['1-grams']
+
+        def color(metric, isPercent=True):
+            out.append(format_color(item, metric, render, isPercent))
+
+        out.append('\n')
 
         # header
-        print(item['name'])
-        layout.pretty_print(item['file'], config)
-        print()
+        out.append(item['name'] + '\n')
+        out.append(layout.render(item['file'], render['colors'], monograms))
+        out.append('\n')
 
-        print('Trigrams')
-        print('========')
+        out.append('Trigrams\n')
+        out.append('========\n')
 
         # alternation
-        print('Alternates -'.rjust(12, ' '), end=' ')
-        print('Total:', end=' ')
-        print_color(item, 'alternate', results, config)
-        print()
+        out.append('Alternates -'.rjust(12, ' ') + ' Total: ')
+        color('alternate')
+        out.append('\n')
 
         # rolls
-        print('Rolls -'.rjust(12, ' '), end=' ')
-        print('Total:', end=' ')
-        print_color(item, 'roll', results, config)
-        print('In:', end=' ')
-        print_color(item, 'roll-in', results, config),
-        print('Out:', end=' ')
-        print_color(item, 'roll-out', results, config)
-        print('Ratio:', end=' ')
-        print_color(item, 'roll-rt', results, config, False)
-        print()
+        out.append('Rolls -'.rjust(12, ' ') + ' Total: ')
+        color('roll')
+        out.append('In: ')
+        color('roll-in')
+        out.append('Out: ')
+        color('roll-out')
+        out.append('Ratio: ')
+        color('roll-rt', False)
+        out.append('\n')
 
         # onehands
-        print('Onehands -'.rjust(12, ' '), end=' ')
-        print('Total:', end=' ')
-        print_color(item, 'onehand', results, config)
-        print('In:', end=' ')
-        print_color(item, 'oneh-in', results, config),
-        print('Out:', end=' ')
-        print_color(item, 'oneh-out', results, config)
-        print('Ratio:', end=' ')
-        print_color(item, 'oneh-rt', results, config, False)
-        print()
+        out.append('Onehands -'.rjust(12, ' ') + ' Total: ')
+        color('onehand')
+        out.append('In: ')
+        color('oneh-in')
+        out.append('Out: ')
+        color('oneh-out')
+        out.append('Ratio: ')
+        color('oneh-rt', False)
+        out.append('\n')
 
         # redirects
-        print('Redirects -'.rjust(12, ' '), end=' ')
-        print('Total:', end=' ')
-        print_color(item, 'redirect', results, config)
-        print()
+        out.append('Redirects -'.rjust(12, ' ') + ' Total: ')
+        color('redirect')
+        out.append('\n')
 
         # unknown
         if item['metrics']['unknown'] > 0:
-            print('Unknown -'.rjust(12, ' '), end=' ')
-            print('Total:', end=' ')
-            print_color(item, 'unknown', results, config)
-            print()
+            out.append('Unknown -'.rjust(12, ' ') + ' Total: ')
+            color('unknown')
+            out.append('\n')
 
-        print()
+        out.append('\n')
 
         # sfb/dsfb/sfT/sfR
-        print('Same Finger')
-        print('===========')
-
-        print('SFB -'.rjust(12, ' '), end='')
-        print_color(item, 'sfb', results, config)
-        print('DSFB -'.rjust(12, ' '), end='')
-        print_color(item, 'dsfb', results, config)
-        print()
-
-        print('SFT -'.rjust(12, ' '), end='')
-        print_color(item, 'sfT', results, config)
-        print('SFR -'.rjust(12, ' '), end='')
-        print_color(item, 'sfR', results, config)
-        print()
-
-        print()
+        out.append('Same Finger\n')
+        out.append('===========\n')
+
+        out.append('SFB -'.rjust(12, ' '))
+        color('sfb')
+        out.append('DSFB -'.rjust(12, ' '))
+        color('dsfb')
+        out.append('\n')
+
+        out.append('SFT -'.rjust(12, ' '))
+        color('sfT')
+        out.append('SFR -'.rjust(12, ' '))
+        color('sfR')
+        out.append('\n')
+
+        out.append('\n')
+
+        # true sfb/sfs/lsb/scissor
+        out.append('Bigrams\n')
+        out.append('=======\n')
+
+        out.append('True SFB -'.rjust(12, ' '))
+        color('true-sfb')
+        out.append('SFS -'.rjust(12, ' '))
+        color('sfs')
+        out.append('\n')
+
+        out.append('LSB -'.rjust(12, ' '))
+        color('lsb')
+        out.append('Scissor -'.rjust(12, ' '))
+        color('scissor')
+        out.append('\n')
+
+        out.append('\n')
+
+        # roll/alternate/redirect chains, only for data with 4- and 5-grams
+        if any(item['metrics'][stat] > 0 for stat in analyzer.get_chain_stats() if 'chain' in stat):
+            out.append('Chains\n')
+            out.append('======\n')
+
+            for n in corpus.LONG:
+                out.append((str(n) + '-grams -').rjust(12, ' ') + ' ')
+                for chain in analyzer.CHAINS:
+                    out.append(chain.title() + ': ')
+                    color(chain + '-chain-' + str(n))
+                out.append('\n')
+
+            out.append('\n')
 
         # finger use
-        print("Finger Use")
-        print("==========")
+        out.append("Finger Use\n")
+        out.append("==========\n")
 
-        print('Left -'.rjust(12, ' '), end=' ')
-        print('Total:', end=' ')
-        print_color(item, 'LTotal', results, config)
+        out.append('Left -'.rjust(12, ' ') + ' Total: ')
+        color('LTotal')
         for finger in ['LP','LR','LM','LI']:
-            print(finger + ':', end=' ')
-            print_color(item, finger, results, config)
-        print()
+            out.append(finger + ': ')
+            color(finger)
+        out.append('\n')
 
-        print('Right -'.rjust(12, ' '), end=' ')
-        print('Total:', end=' ')
-        print_color(item, 'RTotal', results, config)
+        out.append('Right -'.rjust(12, ' ') + ' Total: ')
+        color('RTotal')
         for finger in ['RP','RR','RM','RI']:
-            print(finger + ':', end=' ')
-            print_color(item, finger, results, config)
-        print()
+            out.append(finger + ': ')
+            color(finger)
+        out.append('\n')
 
         if (config['thumb-space'] != 'NONE'):
-            print('Thumb -'.rjust(12, ' '), end=' ')
-            print('Total:', end=' ')
-            print_color(item, 'TB', results, config)
-            print()
+            out.append('Thumb -'.rjust(12, ' ') + ' Total: ')
+            color('TB')
+            out.append('\n')
 
-        print()
+        out.append('\n')
 
         # row use
-        print("Row Use")
-        print("=======")
+        out.append("Row Use\n")
+        out.append("=======\n")
+
+        out.append('Top -'.rjust(12, ' ') + ' ')
+        color('top')
+        out.append('Home -'.rjust(12, ' ') + ' ')
+        color('home')
+        out.append('Bottom -'.rjust(12, ' ') + ' ')
+        color('bottom')
+        out.append('\n')
 
-        print('Top -'.rjust(12, ' '), end=' ')
-        print_color(item, 'top', results, config)
-        print('Home -'.rjust(12, ' '), end=' ')
-        print_color(item, 'home', results, config)
-        print('Bottom -'.rjust(12, ' '), end=' ')
-        print_color(item, 'bottom', results, config)
-        print()
+    sys.stdout.write(''.join(out))
 
 
 
@@ -345,6 +683,12 @@ def flatten(section: JSON):
     return res
         
 
+def get_metric_names():
+
+    # every metric has a column in the default config
+    return flatten(json.load(open(os.path.join('src', 'static', 'config-init.json'), 'r'))['columns'])
+
+
 def get_states(section: JSON):
 
     if type(section) == bool:
@@ -381,13 +725,61 @@ def set_states(section: JSON, new_state: bool):
             set_states(section[item], new_state)
 
 
-def parse_args(name='', action=None, *args):
+def parse_metrics(args: List[str]):
+
+    metrics = {}
+
+    count = 0
+    total_percent = 0
+
+    for arg in args:
+        # parse metric string
+        if not '%' in arg:
+            if arg[0] == '-':
+                arg = ('-', arg[1:])
+            else:
+                arg = ('', arg)
+            count += 1
+        else:
+            arg = arg.split('%')
+            total_percent += abs(float(arg[0]))
+
+        metrics[arg[1]] = arg[0]
+
+    # calculate percent per unassigned metric
+    if count:
+        percent_left = (100 - total_percent) / count
+    else:
+        percent_left = 0
+    
+    # allocate percents and convert to float
+    for item in metrics:
+        if metrics[item] in ['', '-']:
+            metrics[item] += str(percent_left)
+        metrics[item] = float(metrics[item]) / 100
+
+    return metrics
+
+
+def find_layout(config: JSON, name: str):
+
+    for entry in scan_layouts(config):
+        if entry['name'].lower() == name.lower():
+            return layout.load_file(entry['file'])
+
+
+def read_config():
 
-    # open/init config
     try:
-        config = json.load(open('config.json', 'r'))
+        return json.load(open('config.json', 'r'))
     except FileNotFoundError:
-        config = init_config()
+        return None
+
+
+def parse_args(name='', action=None, *args):
+
+    # open/init config
+    config = read_config() or init_config()
 
     # parse args
     if action in ['view', 'vw']:
@@ -430,42 +822,59 @@ def parse_args(name='', action=None, *args):
 
         config['single-mode']['active'] = False
 
-        config['sort'] = {}
-
-        count = 0
-        total_percent = 0
-
         for arg in args:
             # sorting direction
             if arg in ['high', 'h']:
                 config['sort-high'] = True
             elif arg in ['low', 'l']:
                 config['sort-high'] = False
-            # parse metric string
-            else:
-                if not '%' in arg:
-                    if arg[0] == '-':
-                        arg = ('-', arg[1:])
-                    else:
-                        arg = ('', arg)
-                    count += 1
-                else:
-                    arg = arg.split('%')
-                    total_percent += abs(float(arg[0]))
 
-                config['sort'][arg[1]] = arg[0]
+        config['sort'] = parse_metrics([arg for arg in args if not arg in ['high', 'h', 'low', 'l']])
+
+    elif action in ['optimize', 'op']:
 
-        # calculate percent per unassigned metric
-        if count:
-            percent_left = (100 - total_percent) / count
+        config['single-mode']['active'] = True
+
+        if not args:
+            print('give a layout to optimize')
+            exit()
+
+        iterations = optimize.ITERATIONS
+        metrics = []
+        for arg in args[1:]:
+            if arg.isdigit():
+                iterations = int(arg)
+            else:
+                metrics.append(arg)
+
+        # fall back to the current sort weights, sorting by name has none
+        if metrics:
+            weights = parse_metrics(metrics)
+        elif type(config['sort']) == dict and config['sort']:
+            weights = config['sort']
         else:
-            percent_left = 0
-        
-        # allocate percents and convert to float
-        for item in config['sort']:
-            if config['sort'][item] in ['', '-']:
-                config['sort'][item] += str(percent_left)
-            config['sort'][item] = float(config['sort'][item]) / 100
+            print('no metrics to optimize for, give some or sort by them first')
+            exit()
+
+        unknown = [metric for metric in weights if not metric in get_metric_names()]
+        if unknown:
+            print('unknown metric ' + ', '.join(unknown))
+            exit()
+
+        keys = find_layout(config, args[0])
+        if keys is None:
+            print('layout ' + args[0] + ' not found')
+            exit()
+
+        outfile = keys['file'] + '-opt'
+
+        data = get_data(corpus.get_path(config['datadir'], config['datafile']))
+        score = optimize.optimize(keys['file'], outfile, data, config, weights, iterations)
+        print('wrote', outfile, "score {:.4f}".format(score))
+
+        name = layout.load_file(outfile)['name'].lower()
+        config['layouts'][name] = True
+        config['single-mode']['layouts'] = [name]
 
     elif action in ['filter', 'fl']:
 
@@ -483,15 +892,27 @@ def parse_args(name='', action=None, *args):
         for item in config['filter']:
             config['filter'][item] = float(config['filter'][item]) / 100
 
+    elif action in ['pareto', 'pt']:
+
+        config['single-mode']['active'] = False
+
+        # metric directions, -metric prefers low values
+        config['pareto'] = {arg.lstrip('-'): -1 if arg[0] == '-' else 1 for arg in args}
+
     elif action in ['thumb', 'tb']:
         
         if args[0].upper() in ['LT', 'RT', 'NONE', 'AVG']:
             config['thumb-space'] = args[0].upper()
 
     elif action in ['data', 'dt']:
-        
-        if os.path.isfile(os.path.join(config['datadir'], args[0] + '.json')):
-            config['datafile'] = args[0]
+
+        # several corpora with weights, e.g. 60%monkeytype-quotes 40%discord, make a blend
+        blend = parse_metrics(args) if len(args) > 1 or '%' in args[0] else {}
+        names = list(blend) or args[:1]
+
+        if all(os.path.isfile(corpus.get_path(config['datadir'], name)) for name in names):
+            config['datafile'] = names[0]
+            config['blend'] = {name: weight for name, weight in blend.items() if weight > 0}
 
     elif action in ['theme', 'tm']:
 
@@ -523,18 +944,17 @@ def parse_args(name='', action=None, *args):
         filename = os.path.join(config['configdir'], filename + '.json')
         if command == 'save':
 
-            if not os.path.isdir(config['configdir']):
-                os.mkdir(config['configdir'])
-
-            with open(filename, 'w') as f:
-                f.write(json.dumps(config, indent=4))
+            os.makedirs(config['configdir'], exist_ok=True)
+            store.write_file(filename, json.dumps(config, indent=4))
         elif command == 'load':
             if os.path.isfile(filename):
                 config = json.load(open(filename, 'r'))
 
     elif action in ['cache', 'cc']:
 
-        shutil.rmtree(config['cachedir'])
+        shutil.rmtree(config['cachedir'], ignore_errors=True)
+        cached.clear()
+        cached_raws.clear()
 
     elif action in ['help', 'hp', 'h', '?']:
         
@@ -562,22 +982,79 @@ def parse_args(name='', action=None, *args):
     return config
 
 
-if __name__ == "__main__":
+def run(argv: List[str]):
 
-    config = parse_args(*sys.argv)
+    args, flags = cli.parse_flags(argv)
 
-    if config['single-mode']['active']:
-        layout_config = copy.deepcopy(config)
-        layout_config['layouts'] = {item: False for item in layout_config['layouts']}
+    response = {
+        'output': '',
+        'config': None,
+        'results': None,
+    }
 
-        for layout_name in layout_config['single-mode']['layouts']:
-            layout_config['layouts'][layout_name] = True
-    
-        results = get_results(layout_config)
-        print_layout(results, layout_config)
-    else:
-        results = get_results(config)
-        show_results(results, config)
+    # the config as it was, so an unchanged one isn't rewritten
+    saved = read_config()
+
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            config = parse_args(*args)
+        except SystemExit:
+            # help and rejected commands print and leave the config untouched
+            response['output'] = out.getvalue()
+            return response
+
+        # --jobs overrides the config for this run only, 0 means every core
+        jobs = flags.get('jobs', config.get('jobs', 1)) or os.cpu_count()
+
+        if config['single-mode']['active']:
+            layout_config = copy.deepcopy(config)
+            layout_config['layouts'] = {item: False for item in layout_config['layouts']}
+
+            for layout_name in layout_config['single-mode']['layouts']:
+                layout_config['layouts'][layout_name] = True
+        
+            results = get_results(layout_config, jobs, flags.get('approx', False))
+            print_layout(results, layout_config)
+        else:
+            results = get_results(config, jobs, flags.get('approx', False))
+            show_results(results, config)
+
+    if config != saved:
+        store.write_file('config.json', json.dumps(config, separators=store.COMPACT))
+
+    response['output'] = out.getvalue()
+    response['config'] = config
+    response['results'] = results
+
+    return response
+
+
+def run_local(argv: List[str]):
+
+    # what no server answered, serving itself included
+    args, flags = cli.parse_flags(argv)
+
+    if args[1:2] == ['serve']:
+        server.serve(run)
+        return None
+
+    profile = timing.get_setting(flags.get('profile'))
+    if not profile:
+        return run(argv)
+
+    timing.start(profile, [
+        (sys.modules[__name__], ['get_results', 'sort_results', 'show_results', 'print_layout']),
+        (layout, ['load_dir', 'scan_dir', 'load_file', 'render']),
+        (analyzer, ['get_results', 'get_raw_batch', 'get_raw_parallel', 'rescore_raw']),
+        (corpus, ['load', 'encode']),
+    ])
+    response = run(argv)
+    timing.stop()
+
+    return response
+
+
+if __name__ == "__main__":
 
-    with open('config.json', 'w') as f:
-        f.write(json.dumps(config, indent=4))
\ No newline at end of file
+    cli.main(sys.argv, run_local)
@@ -0,0 +1,314 @@
+import math
+import random
+import numpy as np
+import analyzer, corpus, layout
+from typing import Dict, List
+
+JSON = Dict[str, any]
+
+ITERATIONS = 20000
+TEMPERATURE = .005
+
+PAIRS = ['bigrams', 'skipgrams']
+
+
+def get_index(grams: np.ndarray, size: int):
+
+    # char id -> ids of the n-grams that contain it
+    return [np.nonzero((grams == i).any(axis=1))[0] for i in range(size)]
+
+
+def get_slots(tokens: List[List[str]]):
+
+    fingers = ['LP', 'LR', 'LM', 'LI', 'RI', 'RM', 'RR', 'RP']
+
+    chars = tokens[:len(tokens) // 2]
+    indexes = tokens[len(tokens) // 2:]
+
+    # one slot per key that load_file would place
+    slots = []
+    for i in range(len(tokens) // 2):
+        for j, (token, index) in enumerate(zip(chars[i], indexes[i])):
+            slots.append({
+                'token': token,
+                'finger': analyzer.FINGERS.index(fingers[int(index)]),
+                'row': i,
+                'col': j,
+            })
+
+    return slots
+
+
+def init_state(keys: JSON, slots: List[JSON], data: JSON, thumb: str):
+
+    arrays = corpus.encode(data)
+    chars = arrays['chars']
+
+    state = {
+        'arrays': arrays,
+        'index': get_index(arrays['trigrams'], len(chars)),
+        'slots': slots,
+        'thumb': thumb,
+        'fingers': {},
+        'counts': {},
+        'sums': {},
+        'long': {},
+        'chains': {},
+    }
+
+    # char ids moved by each slot's token
+    for slot in slots:
+        slot['chars'] = [chars.index(char) for char in layout.split_token(slot['token']) if char in chars]
+
+    state['rows'] = analyzer.get_rows([keys], chars)[0]
+    state['cols'] = analyzer.get_cols([keys], chars)[0]
+    for mode in analyzer.get_thumbs(thumb):
+        counts = arrays['counts']
+        if mode == 'NONE':
+            counts = np.where(arrays['spaces'], 0, counts)
+
+        state['fingers'][mode] = analyzer.get_fingers([keys], chars, mode)[0]
+        state['counts'][mode] = counts
+        state['sums'][mode] = analyzer.count_trigrams_batch(state['fingers'][mode][None], arrays, mode)[0]
+
+        # 4- and 5-grams are kept as chain sums and updated per swap like the trigrams
+        state['long'][mode] = analyzer.get_long_grams(arrays, mode)
+        state['chains'][mode] = [
+            np.bincount(
+                analyzer.get_chain_table(n)[analyzer.get_sequences(state['fingers'][mode], ids)],
+                weights=counts,
+                minlength=len(analyzer.CHAINS) + 1
+            )
+            for n, ids, counts in state['long'][mode]
+        ]
+
+    state['long-index'] = {n: get_index(ids, len(chars)) for n, ids, counts in next(iter(state['long'].values()))}
+
+    # pair and use sums are kept like the trigram sums, only a swap's moved characters update them
+    state['pair-index'] = {name: get_index(arrays[name], len(chars)) for name in PAIRS}
+    state['pair-counts'] = {name: arrays[name[:-1] + '-counts'].astype(np.float64) for name in PAIRS}
+    state['pairs'] = get_pair_sums(state, {name: slice(None) for name in PAIRS})
+    state['pairs']['bigrams'] = float(state['pair-counts']['bigrams'].sum())
+    state['pairs']['skipgrams'] = float(state['pair-counts']['skipgrams'].sum())
+
+    state['monograms'], state['space-count'] = analyzer.get_use_weights(arrays)
+    fingers = next(iter(state['fingers'].values()))
+    state['use'] = {
+        'fingers': analyzer.count_batch(fingers[None], state['monograms'], len(analyzer.FINGERS))[0],
+        'rows': analyzer.count_batch(state['rows'][None], state['monograms'], 3)[0],
+    }
+
+    return state
+
+
+def get_pair_sums(state: JSON, touched: JSON):
+
+    # pair class sums of the bigrams and skip-grams picked by `touched`, any thumb's finger map will do
+    # since thumbs never make a stretch and space is the only key on one
+    arrays = state['arrays']
+    fingers = next(iter(state['fingers'].values()))[None]
+    rows = state['rows'][None]
+    cols = state['cols'][None]
+
+    # bigrams and skip-grams are classified in one go and split again after
+    bigrams = arrays['bigrams'][touched['bigrams']]
+    pairs = np.concatenate([bigrams, arrays['skipgrams'][touched['skipgrams']]])
+    masks = {stat: mask[0] for stat, mask in analyzer.get_pair_masks(fingers, rows, cols, pairs).items()}
+
+    counts = state['pair-counts']
+    sums = {stat: float(masks[stat][:len(bigrams)] @ counts['bigrams'][touched['bigrams']]) for stat in analyzer.PAIR_CLASSES}
+    sums['sfs'] = float(masks['true-sfb'][len(bigrams):] @ counts['skipgrams'][touched['skipgrams']])
+
+    return sums
+
+
+def add_use(state: JSON, chars: List[int], sign: int):
+
+    # a swap moves a handful of characters, plain item updates beat a bincount on so few
+    fingers = next(iter(state['fingers'].values()))
+    for char in chars:
+        count = sign * state['monograms'][char]
+        if fingers[char] >= 0:
+            state['use']['fingers'][fingers[char]] += count
+        if 0 <= state['rows'][char] < 3:
+            state['use']['rows'][state['rows'][char]] += count
+
+
+def get_chain_data(state: JSON, thumb: str):
+
+    chain_data = {stat: 0.0 for stat in analyzer.get_chain_stats()}
+    for (n, ids, counts), sums in zip(state['long'][thumb], state['chains'][thumb]):
+        chain_data[str(n) + '-grams'] = float(counts.sum())
+        for chain, count in zip(analyzer.CHAINS, sums.tolist()):
+            chain_data[chain + '-chain-' + str(n)] = count
+
+    return chain_data
+
+
+def get_metrics(state: JSON):
+
+    finger_use, row_use = analyzer.get_use(state['use']['fingers'][None], state['use']['rows'][None], state['space-count'])
+
+    raw = {
+        'trigrams': {
+            thumb: dict(zip(analyzer.CLASSES, sums.tolist())) for thumb, sums in state['sums'].items()
+        },
+        'chains': {thumb: get_chain_data(state, thumb) for thumb in state['chains']},
+        'pairs': dict(state['pairs']),
+        'finger-use': finger_use[0],
+        'row-use': row_use[0],
+    }
+
+    return analyzer.get_metrics(raw, state['thumb'])
+
+
+def get_score(state: JSON, weights: JSON):
+
+    metrics = get_metrics(state)
+    return sum(weight * metrics[metric] for metric, weight in weights.items())
+
+
+def move(state: JSON, a: int, b: int):
+
+    slot_a = state['slots'][a]
+    slot_b = state['slots'][b]
+
+    for fingers in state['fingers'].values():
+        fingers[slot_a['chars']] = slot_b['finger']
+        fingers[slot_b['chars']] = slot_a['finger']
+
+    state['rows'][slot_a['chars']] = slot_b['row']
+    state['rows'][slot_b['chars']] = slot_a['row']
+    state['cols'][slot_a['chars']] = slot_b['col']
+    state['cols'][slot_b['chars']] = slot_a['col']
+
+    slot_a['token'], slot_b['token'] = slot_b['token'], slot_a['token']
+    slot_a['chars'], slot_b['chars'] = slot_b['chars'], slot_a['chars']
+
+
+def swap(state: JSON, a: int, b: int):
+
+    arrays = state['arrays']
+    size = len(analyzer.CLASSES)
+
+    # only the n-grams containing a moved character can change class
+    chars = state['slots'][a]['chars'] + state['slots'][b]['chars']
+    touched = get_touched(state['index'], chars, len(arrays['trigrams']))
+    trigrams = arrays['trigrams'][touched]
+    repeats = arrays['repeats'][touched]
+
+    long_touched = {
+        n: get_touched(state['long-index'][n], chars, len(ids))
+        for n, ids, counts in next(iter(state['long'].values()))
+    }
+
+    pair_touched = {name: get_touched(state['pair-index'][name], chars, len(arrays[name])) for name in PAIRS}
+    before_pairs = get_pair_sums(state, pair_touched)
+    add_use(state, chars, -1)
+
+    before = {}
+    before_chains = {}
+    for thumb, fingers in state['fingers'].items():
+        before[thumb] = analyzer.get_classes(fingers, trigrams, repeats)
+        before_chains[thumb] = [
+            analyzer.get_chain_table(n)[analyzer.get_sequences(fingers, ids[long_touched[n]])]
+            for n, ids, counts in state['long'][thumb]
+        ]
+
+    move(state, a, b)
+
+    for stat, value in get_pair_sums(state, pair_touched).items():
+        state['pairs'][stat] += value - before_pairs[stat]
+    add_use(state, chars, 1)
+
+    for thumb, fingers in state['fingers'].items():
+        counts = state['counts'][thumb][touched]
+        after = analyzer.get_classes(fingers, trigrams, repeats)
+        state['sums'][thumb] += (
+            np.bincount(after, weights=counts, minlength=size) -
+            np.bincount(before[thumb], weights=counts, minlength=size)
+        )
+
+        for i, (n, ids, counts) in enumerate(state['long'][thumb]):
+            counts = counts[long_touched[n]]
+            after = analyzer.get_chain_table(n)[analyzer.get_sequences(fingers, ids[long_touched[n]])]
+            state['chains'][thumb][i] += (
+                np.bincount(after, weights=counts, minlength=len(analyzer.CHAINS) + 1) -
+                np.bincount(before_chains[thumb][i], weights=counts, minlength=len(analyzer.CHAINS) + 1)
+            )
+
+
+def get_touched(index: List[np.ndarray], chars: List[int], size: int):
+
+    touched = np.zeros(size, dtype=bool)
+    for char in chars:
+        touched[index[char]] = True
+
+    return np.flatnonzero(touched)
+
+
+def save_sums(state: JSON):
+
+    # the running sums a rejected swap puts back
+    return {
+        'sums': {thumb: sums.copy() for thumb, sums in state['sums'].items()},
+        'chains': {thumb: [sums.copy() for sums in chain_sums] for thumb, chain_sums in state['chains'].items()},
+        'pairs': dict(state['pairs']),
+        'use': {name: sums.copy() for name, sums in state['use'].items()},
+    }
+
+
+def anneal(state: JSON, weights: JSON, iterations: int=ITERATIONS, temperature: float=TEMPERATURE, seed: int=None):
+
+    rng = random.Random(seed)
+    slots = state['slots']
+
+    score = get_score(state, weights)
+    best = (score, [slot['token'] for slot in slots])
+
+    # columns only matter to lateral stretches
+    geometry = ['finger', 'row'] + (['col'] if 'lsb' in weights else [])
+
+    for step in range(iterations):
+        temp = temperature * (1 - step / iterations)
+        a, b = rng.sample(range(len(slots)), 2)
+
+        # the slot geometry is the only thing a swap changes
+        if all(slots[a][item] == slots[b][item] for item in geometry):
+            continue
+
+        saved = save_sums(state)
+        swap(state, a, b)
+        new_score = get_score(state, weights)
+
+        if new_score >= score or (temp > 0 and rng.random() < math.exp((new_score - score) / temp)):
+            score = new_score
+            if score > best[0]:
+                best = (score, [slot['token'] for slot in slots])
+        else:
+            move(state, a, b)
+            state.update(saved)
+
+    return best
+
+
+def optimize(filename: str, outfile: str, data: JSON, config: JSON, weights: JSON, iterations: int=ITERATIONS):
+
+    keys = layout.load_file(filename)
+    name, tokens = layout.get_tokens(filename)
+
+    slots = get_slots(tokens)
+    state = init_state(keys, slots, data, config['thumb-space'])
+    score, best = anneal(state, weights, iterations)
+
+    # write the best permutation back into the original grid
+    best = iter(best)
+    chars = tokens[:len(tokens) // 2]
+    indexes = tokens[len(tokens) // 2:]
+    for i in range(len(chars)):
+        for j in range(min(len(chars[i]), len(indexes[i]))):
+            chars[i][j] = next(best)
+
+    layout.save_file(outfile, name + '-opt', tokens)
+
+    return score
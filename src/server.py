@@ -0,0 +1,81 @@
+import socket
+import json
+import os
+from typing import Dict, List
+
+JSON = Dict[str, any]
+
+SOCKET_FILE = '.a200.sock'
+
+
+def forward(argv: List[str], path: str=SOCKET_FILE):
+
+    # None when no server is listening, the caller then runs the command itself
+    if not os.path.exists(path):
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        client.close()
+        return None
+
+    with client:
+        client.sendall((json.dumps({'argv': argv}) + '\n').encode())
+        client.shutdown(socket.SHUT_WR)
+
+        response = b''
+        for block in iter(lambda: client.recv(1 << 16), b''):
+            response += block
+
+    return json.loads(response)
+
+
+def serve(run, path: str=SOCKET_FILE):
+
+    # `run` takes an argv and returns the command's output, config and results,
+    # asyncio is imported here since clients that only forward never need it
+    import asyncio
+    import signal
+
+    if forward(['', 'ping'], path) is not None:
+        print('a server is already listening on', path)
+        return
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+
+        # one request per connection, commands run one at a time on the loop
+        try:
+            request = json.loads(await reader.readline())
+            if request['argv'][1:2] == ['ping']:
+                response = {'output': '', 'config': None, 'results': None}
+            else:
+                response = run(request['argv'])
+        except Exception as e:
+            response = {'error': repr(e)}
+
+        writer.write((json.dumps(response) + '\n').encode())
+        await writer.drain()
+        writer.close()
+
+    async def listen():
+
+        # ctrl-c and kill both shut down cleanly
+        stop = asyncio.get_running_loop().create_future()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            asyncio.get_running_loop().add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+
+        server = await asyncio.start_unix_server(handle, path)
+        async with server:
+            await stop
+
+    print('serving on', path)
+    try:
+        asyncio.run(listen())
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,254 @@
+import os
+import json
+import sqlite3
+import hashlib
+import tempfile
+import corpus
+from typing import Dict, List
+
+JSON = Dict[str, any]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS corpora (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    hash TEXT,
+    file TEXT
+);
+CREATE TABLE IF NOT EXISTS layouts (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER,
+    size INTEGER,
+    name TEXT,
+    hash TEXT,
+    mirror TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    corpus TEXT,
+    layout TEXT,
+    thumb TEXT,
+    version TEXT,
+    metrics TEXT,
+    PRIMARY KEY (corpus, layout, thumb, version)
+);
+CREATE TABLE IF NOT EXISTS raws (
+    corpus TEXT,
+    layout TEXT,
+    thumb TEXT,
+    version TEXT,
+    path TEXT,
+    tokens TEXT,
+    raw TEXT,
+    PRIMARY KEY (corpus, layout, thumb, version)
+);
+CREATE INDEX IF NOT EXISTS raws_path ON raws (corpus, path, thumb, version);
+'''
+
+# sqlite's limit on parameters per statement
+CHUNK_SIZE = 500
+
+# seconds a run waits on another run's write before giving up
+TIMEOUT = 30
+
+COMPACT = (',', ':')
+
+# raw sums hold every thumb mode, so they are stored once under this key
+ALL_THUMBS = 'ALL'
+
+
+def connect(cachedir: str):
+
+    os.makedirs(cachedir, exist_ok=True)
+
+    # in wal mode readers never wait and concurrent runs only queue their writes
+    conn = sqlite3.connect(os.path.join(cachedir, 'results.db'), timeout=TIMEOUT)
+    conn.execute('PRAGMA journal_mode=WAL')
+
+    # layouts indexed before mirror keys are scanned again
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(layouts)')]
+    if columns and not 'mirror' in columns:
+        with conn:
+            conn.execute('DROP TABLE layouts')
+
+    conn.executescript(SCHEMA)
+
+    return conn
+
+
+def get_mode(filename: str):
+
+    if os.path.exists(filename):
+        return os.stat(filename).st_mode & 0o777
+
+    # the umask can only be read by setting it
+    umask = os.umask(0)
+    os.umask(umask)
+
+    return 0o666 & ~umask
+
+
+def write_file(filename: str, text: str):
+
+    # a temp file renamed over the old one, readers see either version but never half of one
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix='.' + os.path.basename(filename) + '.')
+    try:
+        # the file object owns fd from here, so it is closed whatever fails below
+        with os.fdopen(fd, 'w') as f:
+            # mkstemp makes it 0600, it gets the old file's mode or what open() would have given it
+            os.fchmod(f.fileno(), get_mode(filename))
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def hash_file(filename: str):
+
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+def get_corpus(conn: sqlite3.Connection, path: str):
+
+    # the content hash is only recomputed when the file's mtime or size change
+    stat = os.stat(path)
+    row = conn.execute(
+        'SELECT hash, file FROM corpora WHERE path = ? AND mtime = ? AND size = ?',
+        (path, stat.st_mtime, stat.st_size)
+    ).fetchone()
+
+    if row:
+        return {'hash': row[0], 'file': row[1]}
+
+    info = {
+        'hash': hash_file(path),
+        'file': corpus.load(path)['file'],
+    }
+
+    with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO corpora VALUES (?, ?, ?, ?, ?)',
+            (path, stat.st_mtime, stat.st_size, info['hash'], info['file'])
+        )
+
+    return info
+
+
+def get_results(conn: sqlite3.Connection, corpus_hash: str, hashes: List[str], thumb: str, version: str):
+
+    hashes = list(set(hashes))
+
+    results = {}
+    for i in range(0, len(hashes), CHUNK_SIZE):
+        chunk = hashes[i:i + CHUNK_SIZE]
+        rows = conn.execute(
+            'SELECT layout, metrics FROM results WHERE corpus = ? AND thumb = ? AND version = ? AND layout IN (' +
+            ', '.join('?' * len(chunk)) + ')',
+            [corpus_hash, thumb, version] + chunk
+        )
+        for layout_hash, metrics in rows:
+            results[layout_hash] = json.loads(metrics)
+
+    return results
+
+
+def put_results(conn: sqlite3.Connection, corpus_hash: str, results: JSON, thumb: str, version: str):
+
+    with conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+            [(corpus_hash, layout_hash, thumb, version, json.dumps(metrics, separators=COMPACT)) for layout_hash, metrics in results.items()]
+        )
+
+
+def get_index(conn: sqlite3.Connection):
+
+    index = {}
+    for path, mtime, size, name, layout_hash, mirror in conn.execute('SELECT * FROM layouts'):
+        index[path] = {
+            'file': path,
+            'name': name,
+            'hash': layout_hash,
+            'mirror': mirror,
+            'mtime': mtime,
+            'size': size,
+        }
+
+    return index
+
+
+def put_index(conn: sqlite3.Connection, entries: List[JSON], index: JSON):
+
+    # only entries that were (re)read from disk are written
+    changed = [entry for entry in entries if index.get(entry['file']) != entry]
+    if changed:
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO layouts VALUES (?, ?, ?, ?, ?, ?)',
+                [(entry['file'], entry['mtime'], entry['size'], entry['name'], entry['hash'], entry['mirror']) for entry in changed]
+            )
+
+
+def get_base(conn: sqlite3.Connection, corpus_hash: str, path: str, thumb: str, version: str):
+
+    # the raw sums last stored for a layout file, whatever its keys were then
+    row = conn.execute(
+        'SELECT tokens, raw FROM raws WHERE corpus = ? AND path = ? AND thumb = ? AND version = ? ORDER BY rowid DESC LIMIT 1',
+        (corpus_hash, path, thumb, version)
+    ).fetchone()
+
+    if row:
+        return {'tokens': json.loads(row[0]), 'raw': json.loads(row[1])}
+
+
+def put_raws(conn: sqlite3.Connection, corpus_hash: str, raws: List[JSON], thumb: str, version: str):
+
+    # raws are {'hash', 'path', 'tokens', 'raw'}
+    with conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO raws VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [
+                (corpus_hash, raw['hash'], thumb, version, raw['path'], json.dumps(raw['tokens'], separators=COMPACT), json.dumps(raw['raw'], separators=COMPACT))
+                for raw in raws
+            ]
+        )
+
+
+def get_raws(conn: sqlite3.Connection, corpus_hash: str, hashes: List[str], thumb: str, version: str):
+
+    hashes = list(set(hashes))
+
+    raws = {}
+    for i in range(0, len(hashes), CHUNK_SIZE):
+        chunk = hashes[i:i + CHUNK_SIZE]
+        rows = conn.execute(
+            'SELECT layout, raw FROM raws WHERE corpus = ? AND thumb = ? AND version = ? AND layout IN (' +
+            ', '.join('?' * len(chunk)) + ')',
+            [corpus_hash, thumb, version] + chunk
+        )
+        for layout_hash, raw in rows:
+            raws[layout_hash] = json.loads(raw)
+
+    return raws
+
+
+def get_corpus_raws(conn: sqlite3.Connection, corpus_hash: str, thumb: str, version: str):
+
+    # every layout's raw sums stored for a corpus, in the form put_raws takes
+    rows = conn.execute(
+        'SELECT layout, path, tokens, raw FROM raws WHERE corpus = ? AND thumb = ? AND version = ?',
+        (corpus_hash, thumb, version)
+    )
+
+    return [
+        {'hash': layout_hash, 'path': path, 'tokens': json.loads(tokens), 'raw': json.loads(raw)}
+        for layout_hash, path, tokens, raw in rows
+    ]
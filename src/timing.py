@@ -0,0 +1,144 @@
+import sys
+import os
+import io
+import json
+import time
+import builtins
+import functools
+from collections import Counter
+from typing import Dict, List
+
+JSON = Dict[str, any]
+
+ENV_VAR = 'A200_PROFILE'
+
+# nothing is wrapped or counted until start() is called
+enabled = False
+timers = {}
+counters = Counter()
+events = []
+patched = []
+profiler = None
+output = None
+real_open = builtins.open
+
+
+def get_setting(flag):
+
+    # --profile[=FILE] wins over the environment, '1' only asks for the summary
+    setting = flag or os.environ.get(ENV_VAR)
+    if setting in [None, '', '0']:
+        return None
+
+    return True if setting in [True, '1'] else setting
+
+
+def count(name: str, n: int=1):
+
+    counters[name] += n
+
+
+def wrap(name: str, fn):
+
+    @functools.wraps(fn)
+    def timed(*args, **kwargs):
+
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            timer = timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += end - start
+            events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': start * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': 0,
+            })
+
+    return timed
+
+
+def instrument(module, names: List[str]):
+
+    # swap module attributes for timed wrappers, so calls through the module are timed
+    for name in names:
+        fn = getattr(module, name)
+        patched.append((module, name, fn))
+        setattr(module, name, wrap(module.__name__.replace('__main__', 'main') + '.' + name, fn))
+
+
+def counted_open(*args, **kwargs):
+
+    count('files opened')
+    return real_open(*args, **kwargs)
+
+
+def start(setting, hooks: List[tuple]):
+
+    global enabled, profiler, output
+
+    enabled = True
+    output = setting if setting is not True else None
+
+    for module, names in hooks:
+        instrument(module, names)
+    builtins.open = counted_open
+
+    # a .json output is a chrome trace, anything else gets pstats
+    if output and not output.endswith('.json'):
+        # imported here, every client that forwards to a server imports this module
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+
+def stop(file=sys.stderr):
+
+    global enabled, profiler
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(output)
+        profiler = None
+
+    builtins.open = real_open
+    for module, name, fn in reversed(patched):
+        setattr(module, name, fn)
+    patched.clear()
+    enabled = False
+
+    if output and output.endswith('.json'):
+        trace = events + [
+            {'name': name, 'ph': 'C', 'ts': events[-1]['ts'] if events else 0, 'pid': os.getpid(), 'args': {'count': n}}
+            for name, n in counters.items()
+        ]
+        with open(output, 'w') as f:
+            f.write(json.dumps({'traceEvents': trace}))
+
+    file.write(get_summary())
+
+
+def get_summary():
+
+    out = io.StringIO()
+
+    out.write('function'.ljust(32) + 'calls'.rjust(8) + 'total ms'.rjust(12) + 'mean ms'.rjust(12) + '\n')
+    for name, (calls, seconds) in sorted(timers.items(), key=lambda x: x[1][1], reverse=True):
+        out.write(
+            name.ljust(32) + str(calls).rjust(8) +
+            "{:.2f}".format(seconds * 1000).rjust(12) + "{:.2f}".format(seconds * 1000 / calls).rjust(12) + '\n'
+        )
+
+    out.write('\n' + 'counter'.ljust(32) + 'count'.rjust(12) + '\n')
+    for name, n in sorted(counters.items()):
+        out.write(name.ljust(32) + "{:.0f}".format(n).rjust(12) + '\n')
+
+    if output:
+        out.write('\nwrote ' + output + '\n')
+
+    return out.getvalue()
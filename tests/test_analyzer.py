@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import random
+import pytest
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import analyzer
+import corpus
+import gendata
+import layout
+import main
+import optimize
+
+LAYOUTS = ['qwerty', 'colemak', 'dvorak', 'semimak']
+
+
+def get_layouts():
+
+    return [layout.load_file(os.path.join(ROOT, 'layouts', name)) for name in LAYOUTS]
+
+
+def get_data():
+
+    return json.load(open(os.path.join(ROOT, 'data', 'monkeytype-200.json'), 'r'))
+
+
+def get_text_data(tmp_path, lines: int=40):
+
+    # a small text corpus counted like `gendata text --max-n 5`, with its own 2-grams and skip-grams
+    words = json.load(open(os.path.join(ROOT, 'wordlists', 'monkeytype-1k.json'), 'r'))['texts']
+    rng = random.Random(0)
+    filename = str(tmp_path / 'text.txt')
+    with open(filename, 'w') as f:
+        for i in range(lines):
+            f.write(' '.join(rng.choice(words) for j in range(10)) + '\n')
+
+    grams = gendata.count_stream(filename, max_n=5)
+    data = {'file': filename, '1-grams': grams[0], '2-grams': grams[1], '3-grams': grams[2], 'skip-grams': grams[3]}
+    for n, counts in zip([4, 5], grams[4:]):
+        data[str(n) + '-grams'] = gendata.prune(counts, gendata.MIN_COUNT)
+
+    return data
+
+
+def assert_same(got, expected):
+
+    assert got.keys() == expected.keys()
+    for stat in expected:
+        assert got[stat] == pytest.approx(expected[stat], rel=1e-9, abs=1e-12), stat
+
+
+@pytest.mark.parametrize('thumb', analyzer.MODES)
+def test_reference_matches_vectorized_and_batch(thumb):
+
+    layouts = get_layouts()
+    data = get_data()
+    config = {'thumb-space': thumb}
+
+    batch = analyzer.score_batch(layouts, data, thumb)
+    for keys, scored in zip(layouts, batch):
+        reference = analyzer.get_results(keys, data, config, vectorized=False)
+        assert_same(analyzer.get_results(keys, data, config), reference)
+        assert_same(scored, reference)
+
+
+@pytest.mark.parametrize('thumb', analyzer.MODES)
+def test_reference_reads_binary_corpus(thumb, tmp_path):
+
+    layouts = get_layouts()
+    data = get_data()
+    config = {'thumb-space': thumb}
+
+    filename = str(tmp_path / 'monkeytype-200.bin')
+    corpus.save(filename, dict(data, file='monkeytype-200'))
+    binary = corpus.load(filename)
+
+    for keys in layouts:
+        reference = analyzer.get_results(keys, data, config, vectorized=False)
+        assert_same(analyzer.get_results(keys, binary, config, vectorized=False), reference)
+        assert_same(analyzer.get_results(keys, binary, config), reference)
+
+
+def test_batch_ignores_rows_past_bottom():
+
+    # a fourth row of keys must not spill into the next layout's row counts
+    name, tokens = layout.get_tokens(os.path.join(ROOT, 'layouts', 'qwerty'))
+    rows = len(tokens) // 2
+    tall = layout.parse_tokens(tokens[:rows] + [['e', 't', 'a', 'o']] + tokens[rows:] + [['0', '1', '2', '3']])
+    pine = layout.load_file(os.path.join(ROOT, 'layouts', 'Pine'))
+    data = get_data()
+
+    alone = analyzer.score_batch([pine], data, 'LT')[0]
+    for batch in [[tall, pine], [pine, tall]]:
+        scored = analyzer.score_batch(batch, data, 'LT')
+        assert_same(scored[batch.index(pine)], alone)
+
+
+@pytest.mark.parametrize('thumb', analyzer.MODES)
+def test_binary_text_corpus_matches_json(thumb, tmp_path):
+
+    # counts are stored in narrow integer types, sums over them must not overflow
+    layouts = get_layouts()
+    data = get_text_data(tmp_path)
+
+    filename = str(tmp_path / 'text.bin')
+    corpus.save(filename, dict(data))
+    binary = corpus.load(filename)
+    counts = binary['arrays']['bigram-counts']
+    assert counts.dtype.kind == 'i' and counts.sum() > np.iinfo(counts.dtype).max
+
+    for scored, expected in zip(analyzer.score_batch(layouts, binary, thumb), analyzer.score_batch(layouts, data, thumb)):
+        assert_same(scored, expected)
+
+
+def test_optimizer_sums_on_binary_corpus(tmp_path):
+
+    data = get_text_data(tmp_path)
+    filename = str(tmp_path / 'text.bin')
+    corpus.save(filename, dict(data))
+
+    layoutfile = os.path.join(ROOT, 'layouts', 'qwerty')
+    name, tokens = layout.get_tokens(layoutfile)
+
+    metrics = []
+    for source in [data, corpus.load(filename)]:
+        state = optimize.init_state(layout.load_file(layoutfile), optimize.get_slots(tokens), source, 'AVG')
+        metrics.append(optimize.get_metrics(state))
+
+    assert_same(metrics[1], metrics[0])
+
+
+@pytest.mark.parametrize('thumb', analyzer.MODES)
+def test_chains_match_reference_count(thumb, tmp_path):
+
+    layouts = get_layouts()
+    data = get_text_data(tmp_path, 200)
+    assert data['4-grams'] and data['5-grams']
+
+    # the packed 4- and 5-gram keys decode back to the counted n-grams
+    decoded = corpus.decode(corpus.encode(json.loads(json.dumps(data))))
+    assert decoded['4-grams'] == data['4-grams'] and decoded['5-grams'] == data['5-grams']
+
+    config = {'thumb-space': thumb}
+    chains = analyzer.get_chain_stats()[:-len(corpus.LONG)]
+    for keys, scored in zip(layouts, analyzer.score_batch(layouts, data, thumb)):
+        reference = analyzer.get_results(keys, data, config, vectorized=False)
+        assert any(reference[stat] for stat in chains)
+        for stat in chains:
+            assert scored[stat] == pytest.approx(reference[stat], rel=1e-9, abs=1e-12), stat
+
+
+def get_scored(tmp_path, layoutdir: str, cachedir: str, thumb: str):
+
+    config = {
+        'layoutdir': layoutdir, 'datadir': os.path.join(ROOT, 'data'), 'cachedir': str(tmp_path / cachedir),
+        'datafile': 'monkeytype-200', 'thumb-space': thumb, 'sort': {}, 'filter': {}, 'pareto': {}, 'sort-high': True,
+    }
+    main.cached.clear()
+    return {item['name']: item['metrics'] for item in main.get_results(config)['data']}
+
+
+@pytest.mark.parametrize('swaps', [2, analyzer.MAX_CHANGED // 2, analyzer.MAX_CHANGED])
+@pytest.mark.parametrize('thumb', analyzer.MODES)
+def test_rescore_matches_full_scoring(swaps, thumb, tmp_path, monkeypatch):
+
+    layoutdir = tmp_path / 'layouts'
+    layoutdir.mkdir()
+    filename = layoutdir / 'qwerty'
+    name, tokens = layout.get_tokens(os.path.join(ROOT, 'layouts', 'qwerty'))
+
+    def write(tokens):
+
+        filename.write_text('\n'.join([name] + [' '.join(row) for row in tokens]) + '\n')
+
+    write(tokens)
+    get_scored(tmp_path, str(layoutdir), 'cache', thumb)
+
+    # swapping n pairs of keys moves 2n characters, past MAX_CHANGED the edit is scored in full
+    edited = [list(row) for row in tokens]
+    keys = [(i, j) for i in range(len(tokens) // 2) for j in range(len(tokens[i]))]
+    random.Random(swaps).shuffle(keys)
+    for (a, b), (c, d) in zip(keys[:swaps], keys[swaps:2 * swaps]):
+        edited[a][b], edited[c][d] = edited[c][d], edited[a][b]
+    write(edited)
+
+    rescored = []
+    rescore_raw = analyzer.rescore_raw
+    monkeypatch.setattr(analyzer, 'rescore_raw', lambda *args, **kwargs: rescored.append(rescore_raw(*args, **kwargs)) or rescored[-1])
+    delta = get_scored(tmp_path, str(layoutdir), 'cache', thumb)
+    assert len(rescored) == 1 and (rescored[0] is None) == (2 * swaps > analyzer.MAX_CHANGED)
+
+    full = get_scored(tmp_path, str(layoutdir), 'fresh', thumb)
+    assert_same(delta[name], full[name])
+
+
+@pytest.mark.parametrize('dims', [1, 2, 3, 4])
+def test_pareto_matches_brute_force(dims):
+
+    # values from a small range so points tie on some axes and repeat outright
+    rng = random.Random(dims)
+    for size in [0, 1, 2, 5, 50, 300]:
+        for values in [3, 10]:
+            points = [tuple(rng.randrange(values) for j in range(dims)) for i in range(size)]
+            expected = [
+                i for i, point in enumerate(points)
+                if not any(all(a >= b for a, b in zip(other, point)) and other != point for other in points)
+            ]
+            assert sorted(main.get_pareto(points)) == expected
+
+
+def test_append_checks_recorded_counting(tmp_path):
+
+    filename = str(tmp_path / 'text.bin')
+    data = dict(get_text_data(tmp_path), kind='text', **{'min-count': gendata.MIN_COUNT})
+    corpus.save(filename, data)
+    loaded = corpus.load(filename)
+    assert (loaded['kind'], loaded['min-count']) == ('text', gendata.MIN_COUNT)
+
+    # the 4- and 5-grams under the recorded count are gone, pruning at another one can't be undone
+    with pytest.raises(ValueError):
+        gendata.append_data(filename, data['file'], str(tmp_path), min_count=gendata.MIN_COUNT + 1)
+
+    delta, added, updated = gendata.append_data(filename, data['file'], str(tmp_path))
+    appended = corpus.load(filename)
+    assert (appended['kind'], appended['min-count']) == ('text', gendata.MIN_COUNT)
+    assert all(count > 0 for counts in delta.values() for count in counts.values())
+
+    corpus.save(filename, dict(data, kind='wordlist'))
+    with pytest.raises(ValueError):
+        gendata.append_data(filename, data['file'], str(tmp_path))